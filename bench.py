@@ -0,0 +1,542 @@
+import numpy as np
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import shapefile
+
+import kernels
+
+from geodat import missing_value, open_geodat, read_geodat
+from idw import fill_missing_data
+from tiles import fill_missing_tiled
+from velocity import VelocityField
+from polylines import Polylines
+from streamlines import streamlines_batch, coarsen_lines, \
+    evenly_spaced_streamlines, streamlines_parallel
+from mesh_fiddling import polyline_successors, identify_holes, \
+    write_to_triangle, write_to_geo, write_to_msh, write_to_npz
+
+
+# Size of the synthetic problem at each scale: the grid is nx x nx/2
+# pixels of 100m, with `seeds` streamlines traced through it and an outline
+# made of a glacier boundary and `islands` nunataks, each broken up into
+# `fragments` pieces
+scales = {
+    "small":  {"nx": 512,  "seeds": 100,  "islands": 4,   "fragments": 8},
+    "medium": {"nx": 2048, "seeds": 500,  "islands": 32,  "fragments": 16},
+    "large":  {"nx": 4096, "seeds": 2000, "islands": 128, "fragments": 32}
+}
+
+
+# ----------------------------------------------------------------
+def write_geodat(filename, x, y, q):
+    """
+    Write the field `q` on the grid `x`, `y` to a big-endian float32 geodat
+    file and its .geodat header, the way Ian's files are laid out
+    """
+    ny, nx = q.shape
+    with open(filename + ".geodat", "w") as header:
+        header.write("# 2\n")
+        header.write("; Geodat info\n")
+        header.write("{0} {1}\n".format(nx, ny))
+        header.write("{0} {1}\n".format(x[1] - x[0], y[1] - y[0]))
+        header.write("{0} {1}\n".format(x[0] / 1000.0, y[0] / 1000.0))
+        header.write("&\n")
+
+    q.astype('>f4').tofile(filename)
+
+
+# ---------------------------------------------------------
+def synthetic_velocity(nx, ny, dx = 100.0, max_speed = 5000.0):
+    """
+    Make the velocity field of an idealized outlet glacier: ice in an
+    elliptical basin flows in the +x direction, converging towards the
+    centre line and speeding up towards the terminus at the right edge.
+    Outside the basin there are no data.
+
+    Returns:
+    =======
+    x, y:   the grid coordinates
+    vx, vy: the velocities, with `missing_value` outside the basin
+    """
+    x = -1.0e6 + dx * np.arange(nx)
+    y = -2.5e6 + dx * np.arange(ny)
+
+    s = np.linspace(0.0, 1.0, nx)[np.newaxis, :]
+    t = np.linspace(-1.0, 1.0, ny)[:, np.newaxis]
+
+    vx = 20.0 + max_speed * s**2 * (1.0 - t**2)
+    vy = -0.3 * vx * t * (1.0 - s)
+
+    # The basin is open at the terminus, so streamlines leave the grid there
+    outside = (s - 1.0)**2 / 1.1**2 + t**2 > 0.95
+    vx[outside] = missing_value
+    vy[outside] = missing_value
+
+    return x, y, vx, vy
+
+
+# -----------------------------------------------------------------
+def punch_holes(vx, vy, fraction, max_size, rng):
+    """
+    Knock square holes of random sizes, up to `max_size` pixels on a side,
+    out of the velocities until roughly `fraction` of the grid is missing
+    """
+    ny, nx = vx.shape
+    mean_area = np.mean(np.arange(1, max_size + 1)**2)
+    num_holes = int(fraction * nx * ny / mean_area)
+
+    sizes = rng.integers(1, max_size + 1, num_holes)
+    I = rng.integers(0, ny - max_size, num_holes)
+    J = rng.integers(0, nx - max_size, num_holes)
+
+    for i, j, size in zip(I, J, sizes):
+        vx[i: i + size, j: j + size] = missing_value
+        vy[i: i + size, j: j + size] = missing_value
+
+
+# ----------------------------------------------------
+def write_seeds(filename, x, y, vx, num_seeds, rng):
+    """
+    Write a shapefile holding one multipoint of `num_seeds` streamline
+    seeds, scattered over the part of the grid that has data
+    """
+    I, J = np.where(vx != missing_value)
+    k = rng.choice(len(I), num_seeds, replace = False)
+
+    writer = shapefile.Writer(filename, shapeType = shapefile.MULTIPOINT)
+    writer.field('FIELD', 'C', '1')
+    writer.multipoint(np.column_stack((x[J[k]], y[I[k]])).tolist())
+    writer.record('')
+    writer.close()
+
+
+# -------------------------------------------------------------------
+def outline_loops(x, y, num_islands, rng, spacing = 200.0):
+    """
+    Make the closed loops of a glacier outline: an ellipse around the basin
+    of `synthetic_velocity` and `num_islands` circular nunataks inside it,
+    on a grid of cells so that no two of them come within a few km
+
+    Returns:
+    =======
+    loops: list of (n, 2) arrays of the points of each loop, with the
+           first point repeated at the end
+    """
+    xc, yc = x[-1], 0.5 * (y[0] + y[-1])
+    a, b = 1.05 * (x[-1] - x[0]), 0.49 * (y[-1] - y[0])
+
+    def loop(xc, yc, a, b):
+        n = max(int(2 * np.pi * max(a, b) / spacing), 16)
+        theta = np.linspace(0.0, 2 * np.pi, n + 1)
+        theta[-1] = 0.0
+        return np.column_stack((xc + a * np.cos(theta),
+                                yc + b * np.sin(theta)))
+
+    loops = [ loop(xc, yc, a, b) ]
+
+    # Put the nunataks in a square in the middle of the ellipse, one per cell
+    # of a grid fine enough to hold all of them
+    cells = int(np.ceil(np.sqrt(2 * num_islands)))
+    size = b / cells
+    I, J = np.unravel_index(rng.choice(cells**2, num_islands, replace = False),
+                            (cells, cells))
+    for i, j in zip(I, J):
+        r = size * rng.uniform(0.2, 0.3)
+        loops.append(loop(xc - 0.5 * (a + b) + (j + 0.5) * size,
+                          yc - 0.5 * b + (i + 0.5) * size, r, r))
+
+    return loops
+
+
+# ------------------------------------------------------------------
+def write_outlines(filename, loops, num_fragments, rng, jitter = 1.0):
+    """
+    Break each loop up into `num_fragments` pieces, reverse half of them,
+    jiggle their endpoints by up to `jitter` meters and write them out in a
+    random order to a shapefile, the way outlines digitized by hand usually
+    turn up
+    """
+    pieces = []
+    for points in loops:
+        n = len(points) - 1
+        # Keep the pieces well over the 1km endpoint tolerance long
+        num_pieces = max(2, min(num_fragments, n // 25))
+        cuts = np.linspace(0, n, num_pieces + 1).astype(int)
+        for k in range(len(cuts) - 1):
+            piece = points[cuts[k]: cuts[k + 1] + 1].copy()
+            piece[[0, -1]] += rng.uniform(-jitter, jitter, (2, 2))
+            if rng.random() < 0.5:
+                piece = piece[::-1]
+            pieces.append(piece)
+
+    writer = shapefile.Writer(filename, shapeType = shapefile.POLYLINE)
+    writer.field('FIELD', 'C', '1')
+    for k in rng.permutation(len(pieces)):
+        writer.line([pieces[k].tolist()])
+        writer.record('')
+    writer.close()
+
+
+# ---------------------------------------------------------------
+def make_inputs(directory, nx, seeds, islands, fragments,
+                hole_fraction = 0.02, hole_size = 8, seed = 0):
+    """
+    Generate the synthetic inputs for one scale in `directory`
+
+    Returns:
+    =======
+    stem:     stem of the velocity mosaic, "stem.vx" and "stem.vy"
+    seeds:    name of the seed shapefile
+    outlines: name of the outline shapefile
+    """
+    rng = np.random.default_rng(seed)
+    ny = nx // 2
+
+    x, y, vx, vy = synthetic_velocity(nx, ny)
+    punch_holes(vx, vy, hole_fraction, hole_size, rng)
+
+    stem = os.path.join(directory, "velocity")
+    write_geodat(stem + ".vx", x, y, vx)
+    write_geodat(stem + ".vy", x, y, vy)
+
+    seeds_filename = os.path.join(directory, "seeds.shp")
+    write_seeds(seeds_filename, x, y, vx, seeds, rng)
+
+    outlines_filename = os.path.join(directory, "outlines.shp")
+    write_outlines(outlines_filename, outline_loops(x, y, islands, rng),
+                   fragments, rng)
+
+    return stem, seeds_filename, outlines_filename
+
+
+# -------------------------------------------------------
+def stages(directory, stem, seeds_filename, outlines_filename):
+    """
+    Return a list of pairs `name, run` of the stages of the pipeline to
+    benchmark, where `run()` does the work of that stage on inputs that
+    were prepared beforehand and aren't part of the timing
+    """
+    x, y, vx = open_geodat(stem + ".vx", dtype = np.float64)
+    field = VelocityField.read(stem)
+    interpolator = field.interpolator()
+
+    seeds = Polylines.read(seeds_filename)[0]
+    lines = streamlines_batch(field.x, field.y, field.vx, field.vy,
+                              seeds[:, 0], seeds[:, 1],
+                              interpolator = interpolator)
+    lines = Polylines.from_lists([X for X, Y in lines], [Y for X, Y in lines])
+
+    outlines = Polylines.read(outlines_filename)
+    outlines, successors = polyline_successors(outlines)
+    X, Y = outlines.split()
+
+    def output(name):
+        return os.path.join(directory, name)
+
+    def trace(method):
+        return lambda: streamlines_batch(field.x, field.y,
+                                         field.vx, field.vy,
+                                         seeds[:, 0], seeds[:, 1],
+                                         method = method,
+                                         interpolator = interpolator)
+
+    return [
+        ("read_geodat",
+         lambda: read_geodat(stem + ".vx", fill = False)),
+        ("fill_missing_data",
+         lambda: fill_missing_data(vx, missing_value)),
+        ("fill_missing_data_fft",
+         lambda: fill_missing_data(vx, missing_value, method = "fft")),
+        ("fill_missing_tiled",
+         lambda: fill_missing_tiled(stem + ".vx", output("filled.vx"),
+                                    tile = 1024)),
+        ("VelocityField.read",
+         lambda: VelocityField.read(stem)),
+        ("streamlines_euler", trace("euler")),
+        ("streamlines_rk4", trace("rk4")),
+        ("streamlines_rk45", trace("rk45")),
+        ("evenly_spaced_streamlines",
+         lambda: evenly_spaced_streamlines(field.x, field.y,
+                                           field.vx, field.vy, 2000.0,
+                                           interpolator = interpolator)),
+        ("coarsen_lines",
+         lambda: coarsen_lines(lines.coords, lines.offsets, 500.0)),
+        ("Polylines.read",
+         lambda: Polylines.read(outlines_filename)),
+        ("polyline_successors",
+         lambda: polyline_successors(Polylines.read(outlines_filename))),
+        ("identify_holes",
+         lambda: identify_holes(X, Y, successors)),
+        ("write_to_triangle",
+         lambda: write_to_triangle(output("mesh.poly"), X, Y,
+                                   successors = successors)),
+        ("write_to_geo",
+         lambda: write_to_geo(output("mesh.geo"), X, Y,
+                              successors = successors)),
+        ("write_to_msh",
+         lambda: write_to_msh(output("mesh.msh"), X, Y,
+                              successors = successors)),
+        ("write_to_npz",
+         lambda: write_to_npz(output("mesh.npz"), X, Y,
+                              successors = successors))
+    ]
+
+
+# ----------------------------------
+def time_stage(run, repeat = 3):
+    """
+    Run a stage `repeat` times and return the times taken, then once more
+    under `tracemalloc` to find the peak memory it allocates, in bytes;
+    memory-mapped files don't count towards the peak
+    """
+    times = []
+    for k in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return times, peak
+
+
+# -------------------------------------------------------------
+def run_benchmarks(names, repeat = 3, hole_fraction = 0.02, hole_size = 8,
+                   only = None, workdir = None):
+    """
+    Generate the inputs for each of the scales `names` and time every
+    stage on them, or only those in the list `only`
+
+    Returns:
+    =======
+    results: results[scale][stage] is a dictionary of the best time and all
+             the times taken, in seconds, and the peak memory, in bytes
+    """
+    results = {}
+
+    for name in names:
+        directory = tempfile.mkdtemp(prefix = "bench_" + name + "_",
+                                     dir = workdir)
+        try:
+            inputs = make_inputs(directory, hole_fraction = hole_fraction,
+                                 hole_size = hole_size, **scales[name])
+            results[name] = {}
+
+            for stage, run in stages(directory, *inputs):
+                if only and stage not in only:
+                    continue
+
+                times, peak = time_stage(run, repeat)
+                results[name][stage] = {"time": min(times), "times": times,
+                                        "peak_bytes": peak}
+                print("{0:8s} {1:24s} {2:10.4f} s {3:10.1f} MiB"
+                      .format(name, stage, min(times), peak / 2.0**20))
+                sys.stdout.flush()
+        finally:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    return results
+
+
+# -------------------------------------------------------
+def check_backends(directory, stem, seeds_filename, outlines_filename):
+    """
+    Check that the compiled kernels give exactly the same numbers as the
+    numpy code, for the IDW fill and for each integration method they
+    cover, with and without stopping streamlines at missing data, and that
+    filling on several threads and tracing on several processes give the
+    same results as on one, after the fill has already run in this process
+
+    Returns:
+    =======
+    mismatches: list of the names of the checks that failed
+    """
+    x, y, vx = open_geodat(stem + ".vx", dtype = np.float64)
+    field = VelocityField.read(stem)
+    seeds = Polylines.read(seeds_filename)[0]
+
+    def run():
+        results = {"fill_missing_data": [fill_missing_data(vx, missing_value)],
+                   "fill_missing_data_workers":
+                       [fill_missing_data(vx, missing_value, workers = 4,
+                                          chunk_size = 256)]}
+
+        for stop_at_no_data in (False, True):
+            interpolator = field.interpolator(stop_at_no_data)
+            for method in ("euler", "rk4"):
+                for sign in (1, -1):
+                    lines = streamlines_batch(field.x, field.y,
+                                              field.vx, field.vy,
+                                              seeds[:, 0], seeds[:, 1], sign,
+                                              method = method,
+                                              interpolator = interpolator)
+                    name = "streamlines_{0}{1}{2}".format(
+                        method, "_stop" if stop_at_no_data else "",
+                        "_backward" if sign < 0 else "")
+                    results[name] = [q for line in lines for q in line]
+
+            lines = streamlines_parallel(field.x, field.y, field.vx, field.vy,
+                                         seeds[:, 0], seeds[:, 1],
+                                         workers = 2, chunk_size = 32,
+                                         method = "rk4",
+                                         interpolator = interpolator)
+            name = "streamlines_rk4{0}".format(
+                "_stop" if stop_at_no_data else "")
+            results[name + "_workers"] = [q for line in lines for q in line]
+
+        return results
+
+    saved = kernels.backend
+    try:
+        kernels.backend = "numpy"
+        expected = run()
+        kernels.backend = "numba"
+        results = run()
+    finally:
+        kernels.backend = saved
+
+    def same(P, Q):
+        return (len(P) == len(Q) and
+                all(np.array_equal(p, q) for p, q in zip(P, Q)))
+
+    mismatches = []
+    for name in expected:
+        if not same(expected[name], results[name]):
+            mismatches.append(name)
+        elif name.endswith("_workers") and \
+             not same(results[name], results[name[:-len("_workers")]]):
+            mismatches.append(name)
+
+    return mismatches
+
+
+# -------------------------------------------------------------------
+def compare(results, baseline, threshold = 0.25, min_time = 1.0e-3):
+    """
+    Find the stages that got slower than in the `baseline` results by more
+    than a fraction `threshold`; stages faster than `min_time` seconds in
+    both are too noisy to judge and are ignored
+
+    Returns:
+    =======
+    slower: list of tuples `scale, stage, old time, new time`
+    """
+    slower = []
+
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            old = baseline.get(name, {}).get(stage)
+            if old is None:
+                continue
+
+            new_time, old_time = result["time"], old["time"]
+            if max(new_time, old_time) < min_time:
+                continue
+
+            if new_time > (1.0 + threshold) * old_time:
+                slower.append((name, stage, old_time, new_time))
+
+    return slower
+
+
+# -------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = "Time each stage of the geodat -> streamline -> mesh "
+                      "pipeline on synthetic glacier data")
+    parser.add_argument("--scales", nargs = "+", default = ["small", "medium"],
+                        choices = sorted(scales),
+                        help = "problem sizes to run")
+    parser.add_argument("--stages", nargs = "+", default = None,
+                        help = "only run these stages")
+    parser.add_argument("--repeat", type = int, default = 3,
+                        help = "number of timed runs of each stage")
+    parser.add_argument("--hole-fraction", type = float, default = 0.02,
+                        help = "fraction of the velocity grid knocked out")
+    parser.add_argument("--hole-size", type = int, default = 8,
+                        help = "largest hole, in pixels on a side")
+    parser.add_argument("--output", default = None,
+                        help = "JSON file to save the results to")
+    parser.add_argument("--compare", default = None,
+                        help = "JSON file of earlier results to compare to")
+    parser.add_argument("--threshold", type = float, default = 0.25,
+                        help = "fractional slowdown flagged as a regression")
+    parser.add_argument("--workdir", default = None,
+                        help = "directory for the generated inputs")
+    parser.add_argument("--check", action = "store_true",
+                        help = "only check that the compiled kernels give "
+                               "the same numbers as the numpy code")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        if not kernels.have_numba:
+            print("Numba isn't installed; nothing to check")
+            return
+
+        mismatches = []
+        for name in args.scales:
+            directory = tempfile.mkdtemp(prefix = "bench_" + name + "_",
+                                         dir = args.workdir)
+            try:
+                inputs = make_inputs(directory,
+                                     hole_fraction = args.hole_fraction,
+                                     hole_size = args.hole_size,
+                                     **scales[name])
+                for check in check_backends(directory, *inputs):
+                    mismatches.append(check)
+                    print("MISMATCH: {0} {1}".format(name, check))
+            finally:
+                shutil.rmtree(directory, ignore_errors = True)
+
+        if mismatches:
+            sys.exit(1)
+        print("numba and numpy backends agree")
+        return
+
+    results = run_benchmarks(args.scales, args.repeat, args.hole_fraction,
+                             args.hole_size, args.stages, args.workdir)
+
+    if args.output is not None:
+        report = {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters": {"repeat": args.repeat,
+                           "hole_fraction": args.hole_fraction,
+                           "hole_size": args.hole_size},
+            "results": results
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent = 2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+        slower = compare(results, baseline, args.threshold)
+        for name, stage, old_time, new_time in slower:
+            print("SLOWER: {0} {1} {2:.4f} s -> {3:.4f} s ({4:+.0f}%)"
+                  .format(name, stage, old_time, new_time,
+                          100.0 * (new_time / old_time - 1.0)))
+
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
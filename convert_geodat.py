@@ -3,19 +3,20 @@
 # simplifying to a simple ian file reader 
 
 import numpy as np
-from scipy.io import *
-import struct
-import sys
-import math
-import pylab as plt
-from idw import fill_missing_data
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import geodat
+from velocity import VelocityField
 
 import rasterio
 
 
 def read_geodat(filename):
     """
-    Read in one of Ian's geodat files.
+    Read in one of Ian's geodat files, leaving missing data in place.
 
     Parameters:
     ==========
@@ -28,197 +29,297 @@ def read_geodat(filename):
     x, y: the grid coordinates of the output field
     data: output field
     """
+    return geodat.read_geodat(filename, fill = False)
 
-    def _read_geodat(filename):
-        # read in the .geodat file, which stores the number of pixels,
-        # the pixel size and the location of the lower left corner
-        geodatfile = open(filename, "r")
-        xgeo = np.zeros((3, 2))
-        i = 0
-        while True:
-            line = geodatfile.readline().split()
-            if len(line) == 2:
-                try:
-                    xgeo[i, 0] = float(line[0])
-                    xgeo[i, 1] = float(line[1])
-                    i += 1
-                except ValueError:
-                    i = i
-            if len(line) == 0:
-                break
-        geodatfile.close()
-        xgeo[2, :] = xgeo[2, :] * 1000.0
-        return xgeo
-
-    # Get the data about the grid from the .geodat file
-    xgeo = _read_geodat(filename + ".geodat")
-    nx, ny = map(int, xgeo[0,:])
-    dx, dy = xgeo[1, :]
-    xo, yo = xgeo[2, :]
-
-    x = np.zeros(nx)
-    for i in range(nx):
-        x[i] = xo + i * dx
-
-    y = np.zeros(ny)
-    for i in range(ny):
-        y[i] = yo + i * dy
-
-    # Open the x-velocity file and read in all the binary data
-    data_file = open(filename, "rb")
-    raw_data = data_file.read()
-    data_file.close()
-
-    # Unpack the binary data to an array of floats, knowing that it is
-    # in big-endian format.
-    nvals = len(raw_data)/4
-    arr = np.zeros(nvals)
-    for i in range(nvals):
-        arr[i] = struct.unpack('>f', raw_data[4*i: 4*(i+1)])[0]
-
-    # Reshape the 1D array to 2D
-    data = arr.reshape((ny, nx))
-
-    # Fill in any small patches of missing data
-    #data = fill_missing_data(data, -2.0e+9)
-
-    return x, y, data
-
-def numpyGeoTiff(numpyarray,filename,originalTiff):
-    """
-    Turn a numpy array into a geoTiff
+def geodatProfile(filename, crs="EPSG:3413"):
+    """
+    Build a GeoTIFF profile straight from a .geodat header, so no template
+    tiff is needed
 
     Parameters:
     ==========
-    numpyarray: the 2-d numpy array
-    
-    fileName: the name you want 
-    
-    originalTiff: this is the kicker. You need to give it a proper geoTiff for
-                for it it emulate
+    filename: the name of the geodat file; its header is "filename.geodat"
+
+    crs: the projection of the mosaic; geodat headers don't record it, and
+         the Greenland mosaics are in NSIDC polar stereographic north
 
     Returns:
     =======
-    nothing, but it dumps a tif into the file path you gave it.  
-    """
-    
-    # open the original geotiff 
-    r = rasterio.open(originalTiff)
-    
-    # get its profile info    
-    profile = r.profile
-    
-    # udate to the correct 
-    profile.update(dtype=rasterio.float64,
-                   count=1,
-                   nodata=-2.0e+9)
-    
-    with rasterio.open(filename+"_new.tif", 'w', **profile) as dst:
-        
-        # update the metadata/ the geo part of the geotif
-        #kwargs = dst.meta
-        #kwargs.update(
-        #        dtype=rasterio.float64,
-        #        count=1)
-        
-        # now write the data. 
-        dst.write(numpyarray, 1)
-        
-    return profile
-
-def warpRasterToRaster(rasterToChange,rasterToMatch,outputFileName):
-    """
-    Turn a numpy array into a geoTiff
+    profile: rasterio profile for a tiled, compressed float32 GeoTIFF of the
+             mosaic, flipped so that the first row is the northernmost. The
+             geodat grid coordinates are taken to be pixel centres.
+    """
+    from rasterio.transform import from_origin
+
+    nx, ny, dx, dy, xo, yo = geodat.read_geodat_header(filename)
+
+    west = xo - 0.5 * dx
+    north = yo + (ny - 0.5) * dy
+
+    return {"driver": "GTiff",
+            "width": nx,
+            "height": ny,
+            "count": 1,
+            "dtype": rasterio.float32,
+            "crs": crs,
+            "transform": from_origin(west, north, dx, dy),
+            "nodata": geodat.missing_value,
+            "tiled": True,
+            "blockxsize": 512,
+            "blockysize": 512,
+            "compress": "deflate",
+            "predictor": 3,
+            "num_threads": "ALL_CPUS"}
+
+
+def writeGeoTiff(numpyarray, filename, profile):
+    """
+    Write a numpy array to a GeoTIFF with the given profile, e.g. from
+    geodatProfile; GDAL compresses the tiles on all cores
 
     Parameters:
     ==========
-    rasterToChange: the file you want to regrid/warp
-    
+    numpyarray: the 2-d numpy array, first row northernmost
+
+    filename: the name of the file to write
+
+    profile: rasterio profile of the file
+    """
+    with rasterio.open(filename, "w", **profile) as dst:
+        dst.write(numpyarray.astype(np.float32), 1)
+
+
+def warpArrayToRaster(numpyarray, profile, rasterToMatch, outputFileName):
+    """
+    Warp a numpy array in memory onto the grid of another raster, and
+    write out the result, without writing out the source array first
+
+    Parameters:
+    ==========
+    numpyarray: the 2-d numpy array, first row northernmost
+
+    profile: rasterio profile of the array, e.g. from geodatProfile
+
     rasterToMatch: the file that you want the warped image to match
-    
+
     outputFileName: the name of the output file this function will create
+    """
+    from rasterio.warp import reproject, Resampling
+
+    with rasterio.open(rasterToMatch) as match:
+        dst_profile = dict(profile,
+                           width=match.width,
+                           height=match.height,
+                           crs=match.crs,
+                           transform=match.transform)
+
+    warped = np.empty((dst_profile["height"], dst_profile["width"]),
+                      dtype=np.float32)
+
+    reproject(source=numpyarray.astype(np.float32),
+              destination=warped,
+              src_transform=profile["transform"],
+              src_crs=profile["crs"],
+              src_nodata=profile["nodata"],
+              dst_transform=dst_profile["transform"],
+              dst_crs=dst_profile["crs"],
+              dst_nodata=profile["nodata"],
+              resampling=Resampling.bilinear,
+              num_threads=os.cpu_count() or 1)
+
+    writeGeoTiff(warped, outputFileName, dst_profile)
 
-    Returns:
-    =======
-    nothing, but it dumps a tif into the file path you gave it.  
-    """
-     
-    # this is from stack overflow 
-    # http://stackoverflow.com/questions/10454316/how-to-project-and-resample-a-grid-to-match-another-grid-with-gdal-python
-     
-    from osgeo import gdal, gdalconst
-
-    # Source
-
-    src = gdal.Open(rasterToChange, gdalconst.GA_ReadOnly)
-    src_proj = src.GetProjection()
-    src_geotrans = src.GetGeoTransform()
-    
-    # We want a section of source that matches this:
-    
-    match_ds = gdal.Open(rasterToMatch, gdalconst.GA_ReadOnly)
-    match_proj = match_ds.GetProjection()
-    match_geotrans = match_ds.GetGeoTransform()
-    wide = match_ds.RasterXSize
-    high = match_ds.RasterYSize
-    
-    # Output / destination
-    dst = gdal.GetDriverByName('GTiff').Create(outputFileName, wide, high, 1, gdalconst.GDT_Float32)
-    dst.SetGeoTransform( match_geotrans )
-    dst.SetProjection( match_proj)
-    
-    # Do the work
-    gdal.ReprojectImage(src, dst, src_proj, match_proj, gdalconst.GRA_Bilinear)
-    
-    del dst # Flush
 
 # ===================================================================
-# ===================================================================
-# start the main body of Code 
-# ===================================================================
+# batch conversion of many mosaics
 # ===================================================================
 
-# file to convert 
-pathName = "X:\\Track-All250\\"
-filename_y = pathName +"mosaicOffsets.vy"
-filename_x = pathName +"mosaicOffsets.vx"
+def outputFilenames(stem):
+    """
+    The files the batch conversion writes for the mosaic with geodat
+    files "stem.vx" and "stem.vy"
+    """
+    return {"vx": stem + ".vx_new.tif",
+            "vy": stem + ".vy_new.tif",
+            "magnitude": stem + ".magnitude_new.tif",
+            "warp": stem + ".regrid.tif"}
 
-# pointing this at ians qualitiative picture tif.    
-originalTiff = "X:\\Track-All250\\velocity.tif"  
 
-# x component
+def isUpToDate(output, inputs):
+    """
+    Check whether the file `output` exists and is newer than all of the
+    files `inputs`
+    """
+    if not os.path.exists(output):
+        return False
 
-xx,yx,datax = read_geodat(filename_x)
+    mtime = os.path.getmtime(output)
+    return all(os.path.getmtime(f) <= mtime for f in inputs)
 
-dataFlipX = np.flipud(datax)
 
-numpyGeoTiff(dataFlipX,filename_x,originalTiff)
+def staleStages(stem, rasterToMatch=None, force=False):
+    """
+    Find which of the outputs of the mosaic with geodat files "stem.vx" and
+    "stem.vy" are missing or older than the files they're made from
 
-# y component
+    Returns:
+    =======
+    stages: list of the stages, out of "vx", "vy", "magnitude" and "warp",
+            that need to be (re)built; all of them if `force` is True
+    """
+    outputs = outputFilenames(stem)
+    sources = [stem + ext
+               for ext in (".vx", ".vx.geodat", ".vy", ".vy.geodat")]
 
-xy,yy,datay = read_geodat(filename_y)
+    inputs = {"vx": sources, "vy": sources, "magnitude": sources}
+    if rasterToMatch is not None:
+        inputs["warp"] = sources + [rasterToMatch]
 
-dataFlipY = np.flipud(datay)
+    return [stage for stage in ("vx", "vy", "magnitude", "warp")
+            if stage in inputs and
+            (force or not isUpToDate(outputs[stage], inputs[stage]))]
 
-numpyGeoTiff(dataFlipY,filename_y,originalTiff)
 
+def convertMosaic(stem, stages, rasterToMatch=None, crs="EPSG:3413"):
+    """
+    Read a mosaic once and write out the GeoTIFFs for each of `stages`,
+    warping the speed onto the grid of `rasterToMatch` straight from
+    memory
 
-# vector magnitude 
-# good old trig 
-# a**2 + b** = c**2 
+    Returns:
+    =======
+    timings: dictionary mapping "read" and each of `stages` to the time in
+             seconds it took
+    """
+    outputs = outputFilenames(stem)
+    timings = {}
 
-dataFlip_magnitude = np.sqrt(dataFlipY**2 + dataFlipX**2)
+    start = time.time()
+    field = VelocityField.read(stem, fill=False)
+    profile = geodatProfile(stem + ".vx", crs)
+    timings["read"] = time.time() - start
 
-# re- set the no data values to no data 
-dataFlip_magnitude[dataFlipY == -2.0e+9] = -2.0e+9
+    for stage in stages:
+        start = time.time()
 
-numpyGeoTiff(dataFlip_magnitude,pathName+"Magnitude",originalTiff)
+        if stage == "warp":
+            warpArrayToRaster(np.flipud(field.with_no_data(field.magnitude)),
+                              profile, rasterToMatch, outputs["warp"])
+        else:
+            q = getattr(field, stage)
+            writeGeoTiff(np.flipud(field.with_no_data(q)), outputs[stage],
+                         profile)
 
+        timings[stage] = time.time() - start
 
-# now use gdal warp to match the gridding of each file 
-# warpRasterToRaster(rasterToChange,rasterToMatch,outputFileName):
+    return timings
 
-basalShearTif = "Y:\\Documents\\DATA\\MORLIGHEM_NSIDC\\basal_shear_Pa_Layer.tif"
 
-# this warps the velocity to match the basal shear layer 
-warpRasterToRaster(pathName+"Magnitude"+"_new.tif",basalShearTif,pathName+"testReGrid.tif")
\ No newline at end of file
+def conversionJobs(stems, rasterToMatch=None, force=False):
+    """
+    Work out what has to be done to convert each mosaic in `stems`
+
+    Returns:
+    =======
+    jobs: dictionary mapping each stem to the list of stages to run for it,
+          from staleStages
+    """
+    return {stem: staleStages(stem, rasterToMatch, force) for stem in stems}
+
+
+def runJobs(jobs, rasterToMatch=None, crs="EPSG:3413", workers=None):
+    """
+    Run the jobs from `conversionJobs` on a pool of processes, one mosaic
+    per job, so that each mosaic is only read once; mosaics that are
+    already up to date aren't read at all
+
+    Returns:
+    =======
+    timings: dictionary mapping each stage to a list of the times in
+             seconds its jobs took; skipped stages are recorded as None
+    """
+    timings = {}
+    allStages = ["vx", "vy", "magnitude"]
+    if rasterToMatch is not None:
+        allStages.append("warp")
+
+    for stem, stages in jobs.items():
+        for stage in allStages:
+            if stage not in stages:
+                timings.setdefault(stage, []).append(None)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convertMosaic, stem, stages,
+                                   rasterToMatch, crs)
+                   for stem, stages in jobs.items() if stages]
+
+        for future in as_completed(futures):
+            for stage, t in future.result().items():
+                timings.setdefault(stage, []).append(t)
+
+    return timings
+
+
+def printTimings(timings):
+    """
+    Print a summary of the time spent in each stage of the conversion
+    """
+    print("{0:<10} {1:>6} {2:>8} {3:>10} {4:>10}"
+          .format("stage", "jobs", "skipped", "total (s)", "max (s)"))
+    for stage in ("read", "vx", "vy", "magnitude", "warp"):
+        if stage not in timings:
+            continue
+        times = [t for t in timings[stage] if t is not None]
+        print("{0:<10} {1:>6} {2:>8} {3:>10.2f} {4:>10.2f}"
+              .format(stage, len(timings[stage]),
+                      len(timings[stage]) - len(times),
+                      sum(times), max(times) if times else 0.0))
+
+
+def findMosaics(patterns):
+    """
+    Find the stems of the mosaics given by a list of stems, .vx files, or
+    glob patterns matching either
+    """
+    stems = []
+    for pattern in patterns:
+        # A stem isn't a file itself, so a pattern for stems has to be
+        # matched against their .vx files
+        if not pattern.endswith(".vx"):
+            pattern += ".vx"
+
+        for name in sorted(glob.glob(pattern)):
+            name = name[:-3]
+            if (os.path.exists(name + ".vy")
+                and name not in stems):
+                stems.append(name)
+
+    return stems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert geodat velocity mosaics to GeoTIFFs")
+    parser.add_argument("mosaics", nargs="+",
+                        help="stems of the mosaics, their .vx files, or "
+                             "glob patterns matching either")
+    parser.add_argument("--match", default=None,
+                        help="raster to warp the speed onto")
+    parser.add_argument("--crs", default="EPSG:3413",
+                        help="projection of the mosaics")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes; one per core by default")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild outputs even if they're up to date")
+    args = parser.parse_args(argv)
+
+    stems = findMosaics(args.mosaics)
+    if not stems:
+        parser.error("no mosaics found")
+
+    jobs = conversionJobs(stems, args.match, args.force)
+    printTimings(runJobs(jobs, args.match, args.crs, args.workers))
+
+
+if __name__ == "__main__":
+    main()
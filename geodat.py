@@ -1,79 +1,167 @@
 import numpy as np
-from scipy.io import *
-import struct
-import sys
-import math
+import os
 
+import instrument
 from idw import fill_missing_data
 
 
-def read_geodat(filename):
+# The value Ian's geodat files use to flag missing data
+missing_value = -2.0e+9
+
+
+# ------------------------------------------------
+def no_data_mask(q, missing = missing_value):
     """
-    Read in one of Ian's geodat files.
+    Return a boolean array, True wherever `q` is missing data.
+
+    Rather than testing for exact equality, which breaks as soon as the
+    data have been through any arithmetic, anything within a relative
+    1.0e-6 of the flag counts as missing.
+    """
+    return np.abs(q - missing) <= 1.0e-6 * abs(missing)
+
+
+# ------------------------------
+def read_geodat_header(filename):
+    """
+    Read the .geodat header that accompanies one of Ian's data files.
 
     Parameters:
     ==========
-    filename: the name of the geodat file to read; expects that there is
-              also a file called "filename.geodat", which contains info
-              on grid size, spacing, etc.
+    filename: the name of the geodat data file; the header is expected
+              to be in "filename.geodat"
 
     Returns:
     =======
-    x, y: the grid coordinates of the output field
-    data: output field
+    nx, ny: number of pixels in the x, y directions
+    dx, dy: pixel size
+    xo, yo: location of the lower left corner, in meters
     """
+    # read in the .geodat file, which stores the number of pixels,
+    # the pixel size and the location of the lower left corner
+    geodatfile = open(filename + ".geodat", "r")
+    xgeo = np.zeros((3, 2))
+    i = 0
+    while True:
+        line = geodatfile.readline().split()
+        if len(line) == 2:
+            try:
+                xgeo[i, 0] = float(line[0])
+                xgeo[i, 1] = float(line[1])
+                i += 1
+            except ValueError:
+                i = i
+        if len(line) == 0:
+            break
+    geodatfile.close()
+    xgeo[2, :] = xgeo[2, :] * 1000.0
 
-    def _read_geodat(filename):
-        # read in the .geodat file, which stores the number of pixels,
-        # the pixel size and the location of the lower left corner
-        geodatfile = open(filename, "r")
-        xgeo = np.zeros((3, 2))
-        i = 0
-        while True:
-            line = geodatfile.readline().split()
-            if len(line) == 2:
-                try:
-                    xgeo[i, 0] = float(line[0])
-                    xgeo[i, 1] = float(line[1])
-                    i += 1
-                except ValueError:
-                    i = i
-            if len(line) == 0:
-                break
-        geodatfile.close()
-        xgeo[2, :] = xgeo[2, :] * 1000.0
-        return xgeo
-
-    # Get the data about the grid from the .geodat file
-    xgeo = _read_geodat(filename + ".geodat")
-    nx, ny = map(int, xgeo[0,:])
+    nx, ny = map(int, xgeo[0, :])
     dx, dy = xgeo[1, :]
     xo, yo = xgeo[2, :]
 
-    x = np.zeros(nx)
-    for i in range(nx):
-        x[i] = xo + i * dx
+    return nx, ny, dx, dy, xo, yo
 
-    y = np.zeros(ny)
-    for i in range(ny):
-        y[i] = yo + i * dy
 
-    # Open the x-velocity file and read in all the binary data
-    data_file = open(filename, "rb")
-    raw_data = data_file.read()
-    data_file.close()
+# -------------------------
+def open_geodat(filename, dtype = None):
+    """
+    Memory-map one of Ian's geodat files without reading any of it.
 
-    # Unpack the binary data to an array of floats, knowing that it is
-    # in big-endian format.
-    nvals = len(raw_data)/4
-    arr = np.zeros(nvals)
-    for i in range(nvals):
-        arr[i] = struct.unpack('>f', raw_data[4*i: 4*(i+1)])[0]
+    Parameters:
+    ==========
+    filename: the name of the geodat file to open
+    dtype:    optional; if given, e.g. `np.float32` or `np.float64`, the
+              data are converted to that (native-endian) type and read into
+              memory. By default a read-only, big-endian float32 view of
+              the file is returned and pixels are only read when touched.
 
-    # Reshape the 1D array to 2D
-    data = arr.reshape((ny, nx))
+    Returns:
+    =======
+    x, y: the grid coordinates of the output field
+    data: output field, an array of shape `(ny, nx)`
+    """
+    nx, ny, dx, dy, xo, yo = read_geodat_header(filename)
+
+    x = xo + dx * np.arange(nx)
+    y = yo + dy * np.arange(ny)
+
+    size = os.path.getsize(filename)
+    if size != 4 * nx * ny:
+        raise ValueError("{0} is {1} bytes; expected {2} for a {3} x {4} grid"
+                         .format(filename, size, 4 * nx * ny, ny, nx))
+
+    data = np.memmap(filename, dtype = '>f4', mode = 'r', shape = (ny, nx))
+
+    if dtype is not None:
+        with instrument.timer("geodat.read"):
+            data = data.astype(dtype)
+        instrument.count("geodat.bytes_read", 4 * nx * ny)
+
+    return x, y, data
+
+
+# -------------------------------------------------------------
+def read_geodat_window(filename, rows, cols, dtype = np.float64):
+    """
+    Read a rectangular window out of a geodat file.
+
+    Parameters:
+    ==========
+    filename:   the name of the geodat file to read
+    rows, cols: slices of the grid to read
+    dtype:      optional; the type of the returned data
+
+    Returns:
+    =======
+    x, y: the grid coordinates of the window
+    data: the data in the window
+    """
+    x, y, data = open_geodat(filename)
+
+    with instrument.timer("geodat.read"):
+        window = data[rows, cols].astype(dtype)
+    instrument.count("geodat.bytes_read", 4 * window.size)
+
+    return x[cols], y[rows], window
+
+
+# -----------------------------------
+def geodat_tiles(nx, ny, tile = 1024):
+    """
+    Split an `ny` x `nx` grid into tiles of at most `tile` x `tile` pixels.
+
+    Returns:
+    =======
+    a generator of pairs `rows, cols` of slices, in row-major order
+    """
+    for i in range(0, ny, tile):
+        for j in range(0, nx, tile):
+            yield slice(i, min(i + tile, ny)), slice(j, min(j + tile, nx))
+
+
+# -----------------------------------------------------
+def read_geodat(filename, missing = missing_value, fill = True):
+    """
+    Read in one of Ian's geodat files.
+
+    Parameters:
+    ==========
+    filename: the name of the geodat file to read; expects that there is
+              also a file called "filename.geodat", which contains info
+              on grid size, spacing, etc.
+    missing:  optional; the value used to flag missing data
+    fill:     optional; whether to fill in small patches of missing data
+
+    Returns:
+    =======
+    x, y: the grid coordinates of the output field
+    data: output field
+    """
+    x, y, data = open_geodat(filename, dtype = np.float64)
 
     # Fill in any small patches of missing data
-    data = fill_missing_data(data, -2.0e+9)
+    if fill:
+        data = fill_missing_data(data, missing)
 
     return x, y, data
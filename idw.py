@@ -1,6 +1,14 @@
 
 import numpy as np
-from itertools import izip
+from scipy import ndimage
+from scipy.signal import fftconvolve
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import instrument
+import kernels
+
+
 
 def find_missing_point(q, missing):
     """
@@ -26,11 +34,54 @@ def find_missing_point(q, missing):
     return []
 
 
-def exterior_mask(q, missing):
+def label_holes(q, missing):
+    """
+    Label the connected regions of a gridded dataset that are missing data.
+
+    Parameters:
+    ==========
+    q:       gridded data
+    missing: the value used to flag missing data
+
+    Returns:
+    =======
+    labels:   labels[i, j] = the region that point `i, j` belongs to, or 0
+              if it has data
+    sizes:    sizes[k] = the number of points in region `k`
+    exterior: exterior[k] = True if region `k` touches the edge of the grid
+    """
+    with instrument.timer("idw.label"):
+        labels, num_regions = ndimage.label(q == missing)
+        sizes = np.bincount(labels.ravel(), minlength = num_regions + 1)
+    instrument.count("idw.holes_found", num_regions)
+
+    boundary = np.concatenate((labels[0, :], labels[-1, :],
+                               labels[:, 0], labels[:, -1]))
+    exterior = np.zeros(num_regions + 1, dtype = bool)
+    exterior[boundary] = True
+    exterior[0] = False
+
+    return labels, sizes, exterior
+
+
+# -------------------------------------------------
+def exterior_mask(q, missing, method = "label"):
     """
     Find the connected components of a gridded dataset, divided along
     boundaries of having/missing data.
+
+    With the default `method` = "label", every region of missing data that
+    touches the edge of the grid is exterior. With `method` = "flood", only
+    the region containing the first missing point on the edge is, and the
+    grid wraps around at the edges.
     """
+    if method == "label":
+        labels, sizes, exterior = label_holes(q, missing)
+        return exterior[labels]
+
+    if method != "flood":
+        raise ValueError("Unknown exterior mask method {0}".format(method))
+
     ny, nx = np.shape(q)
     mask = np.zeros((ny, nx), dtype = bool)
 
@@ -52,33 +103,159 @@ def exterior_mask(q, missing):
     return mask
 
 
-def fill_missing_data(q, missing, d = 12):
+# ------------------
+def idw_kernel(d = 12):
+    """
+    Return the offsets and inverse-distance-cubed weights of every point in
+    a (2d+1) x (2d+1) window, excluding the centre.
+    """
+    di, dj = np.mgrid[-d:d+1, -d:d+1]
+    di = di.flatten()
+    dj = dj.flatten()
+
+    centre = (di == 0) & (dj == 0)
+    di, dj = di[~centre], dj[~centre]
+
+    # Compute the weights one at a time, as scalars; numpy's vectorized
+    # power differs from the scalar one in the last bit
+    weights = np.array([1.0 / np.sqrt(r2)**3 for r2 in di**2 + dj**2])
+
+    return di, dj, weights
+
+
+# ---------------------------------------------------
+def _fill_window(qz, vz, I, J, di, dj, weights):
+    """
+    Sum up the weighted data and the weights in the window around each of
+    the points `I, J` of the padded grids `qz`, `vz`
+    """
+    num = np.zeros(len(I))
+    den = np.zeros(len(I))
+
+    for k in range(len(weights)):
+        num += weights[k] * qz[I + di[k], J + dj[k]]
+        den += weights[k] * vz[I + di[k], J + dj[k]]
+
+    return num, den
+
+
+# -----------------------------------------------------------
+@instrument.timed("idw.fill")
+def fill_points(p, q, missing, I, J, d = 12, method = "window",
+                workers = 1, chunk_size = 65536):
+    """
+    Fill in the points `I, J` of the array `p` with the inverse-distance
+    weighted average of the data in `q` around them; see
+    `fill_missing_data` for the other arguments
+    """
+    valid = q != missing
+    di, dj, weights = idw_kernel(d)
+    qz = np.where(valid, q, 0.0)
+
+    if method == "window":
+        # Pad with `d` cells of no data, so that the window is clipped at
+        # the edges of the grid
+        qz = np.pad(qz, d, mode = "constant")
+        vz = np.pad(valid.astype(np.float64), d, mode = "constant")
+
+        chunks = [(I[n: n + chunk_size] + d, J[n: n + chunk_size] + d)
+                  for n in range(0, len(I), chunk_size)]
+
+        fill_window = kernels.fill_window if kernels.use_numba() \
+            else _fill_window
+
+        def fill_chunk(chunk):
+            return fill_window(qz, vz, chunk[0], chunk[1], di, dj, weights)
+
+        # The compiled kernel already spreads each chunk over all the
+        # cores, and Numba's threading layers can't safely be entered from
+        # several Python threads at once, so only numpy gets a thread pool
+        if workers > 1 and not kernels.use_numba():
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                results = list(executor.map(fill_chunk, chunks))
+        else:
+            results = [fill_chunk(chunk) for chunk in chunks]
+
+        num = np.concatenate([np.zeros(0)] + [r[0] for r in results])
+        den = np.concatenate([np.zeros(0)] + [r[1] for r in results])
+
+    elif method == "fft":
+        kernel = np.zeros((2*d + 1, 2*d + 1))
+        kernel[di + d, dj + d] = weights
+
+        num = fftconvolve(qz, kernel, mode = "same")[I, J]
+        den = fftconvolve(valid.astype(np.float64), kernel, mode = "same")[I, J]
+
+        # Roundoff in the FFT leaves tiny nonzero weights where there's
+        # no data at all in the window
+        den[den < 0.5 * weights.min()] = 0.0
+
+    else:
+        raise ValueError("Unknown fill method {0}".format(method))
+
+    found = den != 0.0
+    p[I[found], J[found]] = num[found] / den[found]
+    p[I[~found], J[~found]] = 0.0
+
+    instrument.count("idw.pixels_filled", np.count_nonzero(found))
+    instrument.count("idw.pixels_unfilled", len(found) - np.count_nonzero(found))
+
+    for i, j in zip(I[~found], J[~found]):
+        print("Unable to interpolate at {0}, {1}\n".format(i, j))
+
+
+# ---------------------------------------------------------------
+def fill_missing_data(q, missing, d = 12, method = "window",
+                      max_hole_size = None, workers = 1,
+                      timings = None, chunk_size = 65536):
     """
     Take a gridded data set and fill in any interior points that are missing
     data using inverse-distance weighting.
+
+    Parameters:
+    ==========
+    q:             gridded data
+    missing:       the value used to flag missing data
+    d:             optional; half-width of the window of points used to fill
+                   each missing point; the window is clipped at the grid
+                   edges
+    method:        optional; "window" gathers the window around all missing
+                   points at once, one kernel offset at a time, and gives
+                   exactly the same numbers as a point-by-point loop; "fft"
+                   convolves the whole grid with the kernel, which is faster
+                   when a large fraction of the grid is missing, but only
+                   agrees with "window" up to roundoff
+    max_hole_size: optional; holes with more points than this are left
+                   missing
+    workers:       optional; the number of threads the "window" method uses
+                   to process chunks of missing points; ignored by the
+                   compiled kernel, which uses every core by itself
+    timings:       optional; a dictionary in which to record the time in
+                   seconds spent in each stage
+    chunk_size:    optional; the number of missing points processed at a time
+                   by the "window" method
+
+    Returns:
+    =======
+    p: a copy of `q` with the interior missing points filled in
     """
-    ny, nx = np.shape(q)
-    exterior = exterior_mask(q, missing)
-    p = np.copy(q)
+    if timings is None:
+        timings = {}
+
+    start = time.time()
+    labels, sizes, exterior = label_holes(q, missing)
 
-    I, J = np.where(q == missing)
-    for i, j in izip(I, J):
-        if not exterior[i, j]:
-            weights = 0.0
-            p[i, j] = 0.0
-            for di in range(-d, d+1):
-                for dj in range(-d, d+1):
-                    k = i + di
-                    l = j + dj
-
-                    if q[k, l] != missing and not (i == k and j == l):
-                        weight = 1.0 / np.sqrt(di**2 + dj**2)**3
-                        p[i, j] += weight * q[k, l]
-                        weights += weight
-
-            if weights != 0.0:
-                p[i, j] /= weights
-            else:
-                print("Unable to interpolate at {0}, {1}\n".format(i, j))
+    fillable = ~exterior
+    fillable[0] = False
+    if max_hole_size is not None:
+        fillable &= sizes <= max_hole_size
+
+    I, J = np.where(fillable[labels])
+    timings["mask"] = time.time() - start
+
+    start = time.time()
+    p = np.copy(q)
+    fill_points(p, q, missing, I, J, d, method, workers, chunk_size)
+    timings["fill"] = time.time() - start
 
     return p
@@ -0,0 +1,191 @@
+"""
+Opt-in timers and counters for the stages of the geodat -> streamline ->
+mesh pipeline.
+
+Nothing is recorded until `enable()` is called, or the environment
+variable INSTRUMENT_REPORT is set to the name of a file to write a report
+to when the program exits: a JSON report if the name ends in .json, a
+pstats dump, which `pstats`, snakeviz etc. can read, otherwise. While
+disabled, `timer` hands back a do-nothing context manager and `count`
+returns straight away.
+
+Counters incremented in worker processes, e.g. by
+`streamlines.streamlines_parallel`, stay in those processes and aren't
+included.
+"""
+
+import atexit
+import contextlib
+import functools
+import json
+import marshal
+import os
+import threading
+import time
+
+
+enabled = False
+
+# counters[name] = the total of everything counted under `name`
+counters = {}
+
+# timers[name] = [number of calls, total time, time not spent in any
+# other timer started inside it]
+timers = {}
+
+# The same, split up by the enclosing timer, keyed by (parent, name)
+_callers = {}
+
+_local = threading.local()
+_null = contextlib.nullcontext()
+
+
+# ----------
+def enable():
+    global enabled
+    enabled = True
+
+
+# -----------
+def disable():
+    global enabled
+    enabled = False
+
+
+# ---------
+def reset():
+    """
+    Throw away everything recorded so far
+    """
+    counters.clear()
+    timers.clear()
+    _callers.clear()
+
+
+# -----------------------
+def count(name, n = 1):
+    """
+    Add `n` to the counter `name`
+    """
+    if enabled:
+        counters[name] = counters.get(name, 0) + int(n)
+
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+
+        self.children = 0.0
+        stack.append(self)
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+
+        stack = _local.stack
+        stack.pop()
+        parent = stack[-1].name if stack else None
+        if stack:
+            stack[-1].children += elapsed
+
+        own = elapsed - self.children
+        for key, table in ((self.name, timers),
+                           ((parent, self.name), _callers)):
+            entry = table.setdefault(key, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += own
+
+        return False
+
+
+# ---------------
+def timer(name):
+    """
+    Return a context manager that adds the time spent in it, and one call,
+    to the timer `name`
+    """
+    if enabled:
+        return _Timer(name)
+
+    return _null
+
+
+# ---------------
+def timed(name):
+    """
+    Decorator that times every call of a function under `name`
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+
+            with _Timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# ----------
+def report():
+    """
+    Return everything recorded so far as a dictionary of plain types
+    """
+    return {
+        "counters": dict(counters),
+        "timers": dict((name, {"calls": calls, "total": total, "own": own})
+                       for name, (calls, total, own) in timers.items())
+    }
+
+
+# -------------------------
+def write_json(filename):
+    with open(filename, "w") as report_file:
+        json.dump(report(), report_file, indent = 2, sort_keys = True)
+
+
+# -------------------------
+def dump_stats(filename):
+    """
+    Write the timers out in the format of `cProfile.Profile.dump_stats`,
+    with each timer as a function, so they can be looked at with the same
+    tools as a profile
+    """
+    def key(name):
+        return ("~", 0, name)
+
+    stats = {}
+    for name, (calls, total, own) in timers.items():
+        callers = {}
+        for (parent, child), (n, t, o) in _callers.items():
+            if child == name and parent is not None:
+                callers[key(parent)] = (n, n, o, t)
+
+        stats[key(name)] = (calls, calls, own, total, callers)
+
+    with open(filename, "wb") as stats_file:
+        marshal.dump(stats, stats_file)
+
+
+# ---------------------------
+def _write_at_exit(filename):
+    if filename.endswith(".json"):
+        write_json(filename)
+    else:
+        dump_stats(filename)
+
+
+if os.environ.get("INSTRUMENT_REPORT"):
+    enable()
+    atexit.register(_write_at_exit, os.environ["INSTRUMENT_REPORT"])
@@ -0,0 +1,125 @@
+import numpy as np
+
+
+class Interpolator(object):
+    """
+    Bilinear interpolation of one or more fields defined on the same
+    regular grid `x`, `y`.
+
+    The grid spacing is computed once, and the fields are stacked into a
+    single array so that sampling several of them at a point reads the
+    four surrounding cells only once.
+
+    Parameters:
+    ==========
+    x, y:   coordinates at which the fields are defined
+    fields: the fields to interpolate, each of shape `(len(y), len(x))`
+    dtype:  optional; type in which the stacked fields are stored
+    """
+
+    def __init__(self, x, y, *fields, **kwargs):
+        dtype = kwargs.get("dtype", np.float64)
+        ny, nx = len(y), len(x)
+
+        if len(fields) == 1:
+            q = np.asarray(fields[0], dtype = dtype)[:, :, np.newaxis]
+        else:
+            q = np.empty((ny, nx, len(fields)), dtype = dtype)
+            for k, field in enumerate(fields):
+                q[:, :, k] = field
+
+        self._setup(x, y, q)
+
+    @classmethod
+    def from_stacked(cls, x, y, q, valid = None):
+        """
+        Make an interpolator of the fields stacked along the last axis of
+        the array `q`, which is used as is rather than copied, e.g. when it
+        lives in shared memory.
+
+        If a boolean array `valid` is given, points in any cell with a
+        corner where `valid` is False count as outside the grid.
+        """
+        interpolator = cls.__new__(cls)
+        interpolator._setup(x, y, q, valid)
+
+        return interpolator
+
+    def _setup(self, x, y, q, valid = None):
+        self.x = np.asarray(x, dtype = np.float64)
+        self.y = np.asarray(y, dtype = np.float64)
+        self.nx = len(x)
+        self.ny = len(y)
+        self.dx = self.x[1] - self.x[0]
+        self.dy = self.y[1] - self.y[0]
+
+        self.q = q
+        self.num_fields = q.shape[2]
+        self.valid = valid
+
+    def cells(self, X, Y):
+        """
+        Find the grid cells containing the points `X`, `Y`
+
+        Returns:
+        =======
+        i, j:             indices of the lower left corner of each cell;
+                          0 for points outside the grid
+        alpha_x, alpha_y: fractional position of each point in its cell
+        inside:           inside[k] = True if point `k` is inside the grid,
+                          and in a cell with valid data at all its corners
+                          if the interpolator has a mask
+        """
+        X = np.asarray(X, dtype = np.float64)
+        Y = np.asarray(Y, dtype = np.float64)
+
+        i = np.floor( (Y - self.y[0])/self.dy ).astype(int)
+        j = np.floor( (X - self.x[0])/self.dx ).astype(int)
+
+        inside = (i >= 0) & (i < self.ny - 1) & (j >= 0) & (j < self.nx - 1)
+        i = np.where(inside, i, 0)
+        j = np.where(inside, j, 0)
+
+        if self.valid is not None:
+            valid = self.valid
+            inside &= (valid[i, j] & valid[i, j + 1] &
+                       valid[i + 1, j] & valid[i + 1, j + 1])
+
+        alpha_x = (X - self.x[j]) / self.dx
+        alpha_y = (Y - self.y[i]) / self.dy
+
+        return i, j, alpha_x, alpha_y, inside
+
+    def __call__(self, X, Y, fill = 0.0):
+        """
+        Interpolate all of the fields to the points `X`, `Y`
+
+        Parameters:
+        ==========
+        X, Y: coordinates of the points
+        fill: optional; value returned at points outside the grid
+
+        Returns:
+        =======
+        p:      array of shape `(len(X), num_fields)` of the interpolated
+                values
+        inside: inside[k] = True if point `k` is inside the grid
+        """
+        i, j, alpha_x, alpha_y, inside = self.cells(X, Y)
+        alpha_x = alpha_x[:, np.newaxis]
+        alpha_y = alpha_y[:, np.newaxis]
+
+        q = self.q
+        q00 = q[i, j]
+        q01 = q[i, j + 1]
+        q10 = q[i + 1, j]
+        q11 = q[i + 1, j + 1]
+
+        p = (q00
+                + alpha_x * (q01 - q00)
+                + alpha_y * (q10 - q00)
+                + alpha_x * alpha_y * (q11 + q00 - q10 - q01))
+
+        p[~inside] = fill
+
+        return p, inside
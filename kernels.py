@@ -0,0 +1,253 @@
+"""
+Compiled versions of the innermost loops of the IDW fill and of the
+streamline integrator, used instead of the numpy ones when Numba is
+installed.
+
+The kernels do the same floating-point operations in the same order as
+the numpy code, so both backends give the same numbers. Set `backend` to
+"numpy" to turn them off, e.g. to compare the two.
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+have_numba = numba is not None
+
+# Which implementation to use, "numba" or "numpy"
+backend = "numba" if have_numba else "numpy"
+
+
+# Why a compiled streamline stopped; see `streamlines._count_retired`
+SLOW = 0
+OUTSIDE = 1
+STAGE_OUTSIDE = 2
+MAX_STEPS = 3
+
+
+# ---------------------------
+def use_numba():
+    """
+    Return True if the compiled kernels should be used
+    """
+    return backend == "numba" and have_numba
+
+
+if have_numba:
+    # -------------------------------------------------------------
+    @numba.njit(parallel = True, cache = True)
+    def fill_window(qz, vz, I, J, di, dj, weights):
+        """
+        Same as `idw._fill_window`, with the points handled in parallel
+        """
+        num = np.zeros(len(I))
+        den = np.zeros(len(I))
+
+        for m in numba.prange(len(I)):
+            a = 0.0
+            b = 0.0
+            for k in range(len(weights)):
+                a += weights[k] * qz[I[m] + di[k], J[m] + dj[k]]
+                b += weights[k] * vz[I[m] + di[k], J[m] + dj[k]]
+            num[m] = a
+            den[m] = b
+
+        return num, den
+
+    # -----------------------------------------
+    @numba.njit(cache = True)
+    def _velocity(x, y, q, valid, X, Y):
+        """
+        Same as `Interpolator.__call__` at a single point, for the first
+        two fields in `q`, returning the speed too
+        """
+        ny, nx = len(y), len(x)
+        dx = x[1] - x[0]
+        dy = y[1] - y[0]
+
+        i = int(np.floor( (Y - y[0])/dy ))
+        j = int(np.floor( (X - x[0])/dx ))
+
+        if i < 0 or i >= ny - 1 or j < 0 or j >= nx - 1:
+            return 0.0, 0.0, 0.0, False
+
+        if valid.size > 0 and not (valid[i, j] and valid[i, j + 1] and
+                                   valid[i + 1, j] and valid[i + 1, j + 1]):
+            return 0.0, 0.0, 0.0, False
+
+        alpha_x = (X - x[j]) / dx
+        alpha_y = (Y - y[i]) / dy
+
+        p = np.zeros(2)
+        for f in range(2):
+            q00 = q[i, j, f]
+            q01 = q[i, j + 1, f]
+            q10 = q[i + 1, j, f]
+            q11 = q[i + 1, j + 1, f]
+
+            p[f] = (q00
+                      + alpha_x * (q01 - q00)
+                      + alpha_y * (q10 - q00)
+                      + alpha_x * alpha_y * (q11 + q00 - q10 - q01))
+
+        u, v = p[0], p[1]
+
+        return u, v, np.sqrt(u**2 + v**2), True
+
+    # -------------------------------------------------------------------
+    @numba.njit(cache = True)
+    def _trace(x, y, q, valid, x0, y0, sign, min_speed, max_steps, step,
+               A, b, out_x, out_y):
+        """
+        Trace one streamline the way `streamlines.streamlines_batch` does,
+        with forward Euler if the tableau `A`, `b` is empty and a fixed
+        step Runge-Kutta method otherwise. The points are stored in
+        `out_x`, `out_y` if they're long enough.
+
+        Returns:
+        =======
+        n:      the number of points in the streamline
+        reason: why it stopped
+        """
+        store = len(out_x) > 0
+        num_stages = len(b)
+        kx = np.zeros(max(num_stages, 1))
+        ky = np.zeros(max(num_stages, 1))
+
+        xs, ys = x0, y0
+        if store:
+            out_x[0] = xs
+            out_y[0] = ys
+        n = 1
+
+        u, v, speed, inside = _velocity(x, y, q, valid, xs, ys)
+        if not inside:
+            return n, OUTSIDE
+        if not speed > min_speed:
+            return n, SLOW
+
+        steps = 0
+        while True:
+            if num_stages == 0:
+                dt = sign * step / speed
+                xs = xs + dt * u
+                ys = ys + dt * v
+            else:
+                kx[0] = sign * u / speed
+                ky[0] = sign * v / speed
+
+                for s in range(1, num_stages):
+                    sx = 0.0
+                    sy = 0.0
+                    for l in range(s):
+                        sx += A[s, l] * kx[l]
+                        sy += A[s, l] * ky[l]
+
+                    pu, pv, ps, pin = _velocity(x, y, q, valid,
+                                                xs + step * sx,
+                                                ys + step * sy)
+                    if not (pin and ps > 0.0):
+                        return n, STAGE_OUTSIDE
+
+                    kx[s] = sign * pu / ps
+                    ky[s] = sign * pv / ps
+
+                sx = 0.0
+                sy = 0.0
+                for l in range(num_stages):
+                    sx += b[l] * kx[l]
+                    sy += b[l] * ky[l]
+                xs = xs + step * sx
+                ys = ys + step * sy
+
+            steps += 1
+            if store:
+                out_x[n] = xs
+                out_y[n] = ys
+            n += 1
+
+            u, v, speed, inside = _velocity(x, y, q, valid, xs, ys)
+            if not inside:
+                return n, OUTSIDE
+            if speed <= min_speed:
+                return n, SLOW
+            if steps >= max_steps:
+                return n, MAX_STEPS
+
+    # -------------------------------------------------------------------
+    @numba.njit(parallel = True, cache = True)
+    def _trace_lengths(x, y, q, valid, X0, Y0, sign, min_speed, max_steps,
+                       step, A, b):
+        lengths = np.zeros(len(X0), dtype = np.int64)
+        reasons = np.zeros(len(X0), dtype = np.int64)
+        empty = np.zeros(0)
+
+        for k in numba.prange(len(X0)):
+            lengths[k], reasons[k] = _trace(x, y, q, valid, X0[k], Y0[k],
+                                            sign, min_speed, max_steps, step,
+                                            A, b, empty, empty)
+
+        return lengths, reasons
+
+    # -------------------------------------------------------------------
+    @numba.njit(parallel = True, cache = True)
+    def _trace_points(x, y, q, valid, X0, Y0, sign, min_speed, max_steps,
+                      step, A, b, offsets, Xs, Ys):
+        for k in numba.prange(len(X0)):
+            a, c = offsets[k], offsets[k + 1]
+            _trace(x, y, q, valid, X0[k], Y0[k], sign, min_speed, max_steps,
+                   step, A, b, Xs[a: c], Ys[a: c])
+
+
+# -------------------------------------------------------------------
+def trace_streamlines(interpolator, X0, Y0, sign, min_speed, max_steps,
+                      step, tableau = None):
+    """
+    Trace the streamlines originating at the points `X0`, `Y0` through
+    the velocities of `interpolator`, with forward Euler, or the fixed-step
+    Runge-Kutta method `tableau` if given, one seed per thread.
+
+    Each streamline is traced twice, once to find out how many points it
+    has and then again to store them, so that every seed can write
+    straight into its own part of the output.
+
+    Returns:
+    =======
+    Xs, Ys:  coordinates of the points of all the streamlines
+    offsets: streamline `n` is Xs[offsets[n]: offsets[n + 1]]
+    reasons: why each streamline stopped
+    """
+    if tableau is None:
+        A = np.zeros((0, 0))
+        b = np.zeros(0)
+    else:
+        a, b, b_err = tableau
+        A = np.zeros((len(b), len(b)))
+        for s, row in enumerate(a):
+            A[s, :len(row)] = row
+        b = np.array(b, dtype = np.float64)
+
+    if interpolator.valid is None:
+        valid = np.zeros((0, 0), dtype = bool)
+    else:
+        valid = np.asarray(interpolator.valid)
+
+    args = (interpolator.x, interpolator.y, np.asarray(interpolator.q), valid,
+            np.asarray(X0, dtype = np.float64),
+            np.asarray(Y0, dtype = np.float64),
+            float(sign), float(min_speed), int(max_steps), float(step), A, b)
+
+    lengths, reasons = _trace_lengths(*args)
+
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    Xs = np.zeros(offsets[-1])
+    Ys = np.zeros(offsets[-1])
+
+    _trace_points(*(args + (offsets, Xs, Ys)))
+
+    return Xs, Ys, offsets, reasons
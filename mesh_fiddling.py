@@ -1,6 +1,11 @@
+import numpy as np
+import os
 from numpy import ones, zeros, sqrt
 from matplotlib.path import *
-from itertools import combinations
+from scipy.spatial import cKDTree
+
+from polylines import Polylines
+import instrument
 
 
 def next_segment(X, Y, i, tol = 1000.0):
@@ -28,12 +33,96 @@ def next_segment(X, Y, i, tol = 1000.0):
     return i
 
 
+class EndpointIndex(object):
+    """
+    A k-d tree of the endpoints of every segment in the list-of-lines
+    `X, Y`, for finding the segment adjacent to a given one without
+    scanning all the others.
+
+    Segments can be reversed after the index is built; the index keeps
+    track of which end of each segment is currently its head.
+    """
+
+    def __init__(self, X, Y, tol = 1000.0):
+        self.num_segments = len(X)
+        self.tol = tol
+        self.reversed = zeros(self.num_segments, dtype = bool)
+
+        # Endpoint `k` is the original head of segment `k`, and endpoint
+        # `num_segments + k` is its original tail
+        self.endpoints = zeros((2 * self.num_segments, 2))
+        for k in range(self.num_segments):
+            self.endpoints[k] = X[k][0], Y[k][0]
+            self.endpoints[self.num_segments + k] = X[k][-1], Y[k][-1]
+
+        self.tree = cKDTree(self.endpoints)
+
+    def tail(self, i):
+        n = self.num_segments
+        return self.endpoints[i if self.reversed[i] else n + i]
+
+    def reverse(self, i):
+        self.reversed[i] = not self.reversed[i]
+
+    def candidates(self, i):
+        """
+        Find every segment with an end within `tol` of the tail of segment
+        `i`, in the same order a linear scan would
+
+        Returns:
+        =======
+        a list of pairs `j, head`, where `head` is True if it's the head of
+        segment `j` that matches and False if it's the tail
+        """
+        n = self.num_segments
+        p = self.tail(i)
+
+        matches = []
+        for e in self.tree.query_ball_point(p, self.tol):
+            j = e % n
+            if j != i and sqrt(sum((self.endpoints[e] - p)**2)) < self.tol:
+                head = (e < n) != self.reversed[j]
+                matches.append((j, not head, head))
+
+        return [(j, head) for j, tail, head in sorted(matches)]
+
+    def next_segment(self, i, strict = False):
+        """
+        Find the segment after segment `i`
+
+        Returns:
+        =======
+        j:       the next segment, or `i` if there is none
+        reverse: True if segment `j` has to be reversed to follow `i`
+        """
+        matches = self.candidates(i)
+        if not matches:
+            return i, False
+
+        j, head = matches[0]
+
+        if len(set(k for k, h in matches)) > 1:
+            message = ("Ambiguous join after segment {0}: segments {1} are all "
+                       "within {2}".format(i, sorted(set(k for k, h in matches)),
+                                           self.tol))
+            if strict:
+                raise ValueError(message)
+            print(message)
+
+        return j, not head
+
+
 # -----------------------------------------
-def segment_successors(X, Y, tol = 1000.0):
+def segment_successors(X, Y, tol = 1000.0, strict = False):
     """
     Parameters:
     ==========
-    X, Y: list of lists of the coordinates of each line
+    X, Y:   list of lists of the coordinates of each line
+    tol:    optional; distance within which the ends of two segments are
+            joined
+    strict: optional; if True, raise a ValueError when the end of a
+            segment is within `tol` of more than one other segment, instead
+            of printing a warning and taking the first one
 
     Returns:
     =======
@@ -41,35 +130,76 @@ def segment_successors(X, Y, tol = 1000.0):
     successors: successors[i] = the next segment after `i`
     """
 
-    num_segments = len(X)
-
     # Make copies of the input arrays; we'll be modifying them
     W = X[:]
     Z = Y[:]
 
+    index = EndpointIndex(W, Z, tol)
+    successors = _chain_segments(index, strict)
+
+    for j in np.where(index.reversed)[0]:
+        W[j] = W[j][::-1]
+        Z[j] = Z[j][::-1]
+
+    return W, Z, successors
+
+
+# ---------------------------------------------------
+def polyline_successors(lines, tol = 1000.0, strict = False):
+    """
+    Same as `segment_successors`, but for a `Polylines` collection; rather
+    than copying any segments, the ones that need reversing are only
+    flagged as reversed.
+
+    Returns:
+    =======
+    lines:      a `Polylines` sharing the points of the input, with the
+                reversal flags updated
+    successors: successors[i] = the next segment after `i`
+    """
+    W, Z = lines.split()
+    index = EndpointIndex(W, Z, tol)
+    successors = _chain_segments(index, strict)
+
+    chained = Polylines(lines.coords, lines.offsets,
+                        lines.reversed != index.reversed)
+
+    return chained, successors
+
+
+# ------------------------------------------
+@instrument.timed("mesh.chain")
+def _chain_segments(index, strict = False):
+    """
+    Chain the segments of an `EndpointIndex` together, marking in the index
+    any segments that have to be reversed along the way
+    """
+    num_segments = index.num_segments
+
     segments = set(range(num_segments))
-    successors = range(num_segments)
+    successors = list(range(num_segments))
 
     while segments:
         i0 = segments.pop()
 
         i = i0
-        j = next_segment(W, Z, i, tol)
+        j, reverse = index.next_segment(i, strict)
         while j != i0:
-            if j < 0:
-                j = -j
-                W[j].reverse()
-                Z[j].reverse()
+            if reverse:
+                index.reverse(j)
 
             segments.remove(j)
             successors[i] = j
 
             i = j
-            j = next_segment(W, Z, i, tol)
+            j, reverse = index.next_segment(i, strict)
 
         successors[i] = i0
+        instrument.count("mesh.loops_chained")
 
-    return W, Z, successors
+    instrument.count("mesh.segments_chained", num_segments)
+
+    return successors
 
 
 # -----------------------------------
@@ -82,117 +212,208 @@ def lines_to_paths(X, Y, successors):
         i0 = segments.pop()
         i = i0
 
-        arr = zip(X[i], Y[i])
+        arr = list(zip(X[i], Y[i]))
 
-        j = next_segment(X, Y, i)
+        j = successors[i]
         while j != i0:
             segments.remove(j)
             arr.extend(zip(X[j], Y[j]))
 
             i = j
-            j = next_segment(X, Y, i)
+            j = successors[i]
 
+        # The last vertex of a closed path is ignored, so repeat the first
+        arr.append(arr[0])
         p = Path(arr, closed = True)
         ps.append(p)
 
     return ps
 
 
-# -----------------------
-def point_inside_path(p):
+# ------------------------------------------
+def point_inside_path(p, exclude = ()):
+    """
+    Return a point inside the path p, but outside any of the paths in
+    `exclude`. Triangle needs to have a point contained in any holes in the
+    mesh.
+
+    We cut across the path along a horizontal line halfway up its list of
+    vertex heights; the line is split into intervals that alternate between
+    inside and outside, and we take the middle of the widest interval that
+    is inside.
     """
-    Return a somewhat arbitrary point inside the path p.
-    Triangle needs to have a point contained in any holes in the mesh.
+    polygons = [p.vertices] + [q.vertices for q in exclude]
+
+    heights = np.unique(p.vertices[:, 1])
+    k = len(heights) // 2
+    y = 0.5 * (heights[k - 1] + heights[k])
+
+    crossings = []
+    for v in polygons:
+        y1 = v[:, 1]
+        y2 = np.roll(y1, -1)
+        x1 = v[:, 0]
+        x2 = np.roll(x1, -1)
+
+        c = (y1 <= y) != (y2 <= y)
+        crossings.append(x1[c] + (y - y1[c]) * (x2[c] - x1[c]) / (y2[c] - y1[c]))
+
+    xs = np.sort(np.concatenate(crossings))
+    widths = xs[1::2] - xs[0::2]
+    i = np.argmax(widths)
+
+    return 0.5 * (xs[2*i] + xs[2*i + 1]), y
+
+
+# ------------------------
+def path_nesting(ps):
+    """
+    Find how the closed paths `ps` are nested inside each other
+
+    Returns:
+    =======
+    depth:  depth[i] = the number of paths containing path `i`
+    parent: parent[i] = the innermost path containing path `i`, or -1
     """
+    num_paths = len(ps)
+
+    lower = np.array([p.vertices.min(axis = 0) for p in ps]).reshape(-1, 2)
+    upper = np.array([p.vertices.max(axis = 0) for p in ps]).reshape(-1, 2)
+    area = np.prod(upper - lower, axis = 1)
+
+    depth = np.zeros(num_paths, dtype = int)
+    parent = -np.ones(num_paths, dtype = int)
 
-    x = 0.0
-    y = 0.0
+    for i in range(num_paths):
+        # Only paths whose bounding box holds that of path `i` can contain
+        # it, and since none of the paths cross, it's enough to check one
+        # of its vertices
+        candidates = np.where(np.all(lower <= lower[i], axis = 1) &
+                              np.all(upper >= upper[i], axis = 1))[0]
 
-    i = 0
-    j = len(p)/2
-    # This is sloppy, don't care
-    while not p.contains_point((x, y)):
-        j += 1
-        x = 0.5 * (p.vertices[i, 0] + p.vertices[j, 0])
-        y = 0.5 * (p.vertices[i, 1] + p.vertices[j, 1])
+        v = ps[i].vertices[0]
+        containing = [j for j in candidates
+                      if j != i and ps[j].contains_point(v)]
 
-    return x, y
+        depth[i] = len(containing)
+        if containing:
+            parent[i] = min(containing, key = lambda j: area[j])
+
+    return depth, parent
 
 
 # -----------------------------------
+@instrument.timed("mesh.identify_holes")
 def identify_holes(X, Y, successors):
     """
     Find which segments of the PSLG are the outlines of holes in the mesh
+
+    A path inside an odd number of other paths is a hole, so holes inside
+    islands inside holes come out right. Each hole gets a point inside it
+    but outside of any islands within it.
     """
     xh = []
     yh = []
 
     ps = lines_to_paths(X, Y, successors)
-    for p, q in combinations(ps, 2):
-        if p.contains_path(q):
-            w, z = point_inside_path(q)
+    depth, parent = path_nesting(ps)
+
+    for i, p in enumerate(ps):
+        # Paths that enclose no area, e.g. lone open lines, can't be holes
+        v = p.vertices
+        area = np.sum(v[:-1, 0] * v[1:, 1] - v[1:, 0] * v[:-1, 1])
+
+        if depth[i] % 2 == 1 and area != 0.0:
+            islands = [ps[j] for j in np.where(parent == i)[0]]
+            w, z = point_inside_path(p, islands)
             xh.append(w)
             yh.append(z)
 
+    instrument.count("mesh.holes_found", len(xh))
+
     return xh, yh
 
 
-# --------------------------
-def write_to_triangle(filename, X, Y, tol = 1000.0):
-    """
-    Write out a .poly file
+# -------------------------------------
+def pslg_tables(W, Z, successors):
     """
-    W, Z, successors = segment_successors(X, Y)
+    Build the tables of points and edges of the PSLG made up of the
+    segments `W, Z`, where segment `successors[k]` follows segment `k`.
+    Points and edges are numbered from 1, and edge `n` starts at point `n`.
 
+    Returns:
+    =======
+    x, y:    coordinates of all the points
+    points:  the segment each point belongs to
+    starts:  the point each edge starts at
+    ends:    the point each edge ends at
+    edges:   the segment each edge belongs to
+    offsets: offsets[k] = the number of the first point of segment `k`
+    """
     num_segments = len(W)
-    num_points = sum([len(w) for w in W])
+    lengths = np.array([len(w) for w in W], dtype = int)
 
-    poly_file = open(filename, "w")
-    poly_file.write("{0} 2 0 1\n".format(num_points))
+    offsets = np.ones(num_segments + 1, dtype = int)
+    offsets[1:] += np.cumsum(lengths)
 
-    # Write out the PSLG points
-    counter = 1
-    for k in range(num_segments):
-        w, z = W[k], Z[k]
+    x = np.concatenate([np.asarray(w, dtype = np.float64) for w in W])
+    y = np.concatenate([np.asarray(z, dtype = np.float64) for z in Z])
+    points = np.repeat(np.arange(num_segments), lengths)
 
-        for i in range(len(w)):
-            poly_file.write("{0} {1} {2} {3}\n"
-                            .format(counter + i, w[i], z[i], k))
+    # Each point is joined to the next one in its segment, except for the
+    # last, which is joined to the first point of the next segment. Note
+    # that if a segment is its own successor, this just connects the tail
+    # back to the head.
+    starts = np.arange(1, offsets[-1])
+    ends = starts + 1
+    ends[offsets[1:] - 2] = offsets[np.asarray(successors, dtype = int)]
+    edges = points
 
-        counter += len(w)
+    return x, y, points, starts, ends, edges, offsets
 
 
-    # Write out the PSLG edges
-    poly_file.write("{0} 1\n".format(num_points))
+# ----------------------------------------------------
+def _write_table(f, fmt, columns, chunk_size = 65536):
+    """
+    Write out the rows of a table, formatting `chunk_size` rows at a time
+    and writing each chunk in one go
+    """
+    for n in range(0, len(columns[0]), chunk_size):
+        chunk = [c[n: n + chunk_size].tolist() for c in columns]
+        f.write("".join(map(fmt.format, *chunk)))
 
-    offsets = zeros(num_segments + 1, dtype = int)
-    offsets[0] = 1
-    for k in range(num_segments):
-        offsets[k + 1] = offsets[k] + len(W[k])
+    instrument.count("mesh.lines_written", len(columns[0]))
 
-    counter = 1
-    for k in range(num_segments):
-        w, z = W[k], Z[k]
-
-        # Write out all the edges within this segment
-        for i in range(len(w) - 1):
-            poly_file.write("{0} {1} {2} {3}\n"
-                            .format(counter + i,
-                                    offsets[k] + i,
-                                    offsets[k] + i + 1,
-                                    k + 1))
-
-        # Write out the edge connecting this segment to the next.
-        # Note that if this segment is its own successor, this just
-        # connects the tail back to the head.
-        l = successors[k]
-        poly_file.write("{0} {1} {2} {3}\n"
-                        .format(counter + len(w) - 1,
-                                offsets[k] + len(w) - 1,
-                                offsets[l],
-                                k + 1))
-
-        counter += len(w)
+
+# --------------------------------------------------------------
+@instrument.timed("mesh.write_to_triangle")
+def write_to_triangle(filename, X, Y, tol = 1000.0, successors = None):
+    """
+    Write out a .poly file
+
+    If `successors` is given, `X, Y` are taken to be the already oriented
+    segments returned along with it by `segment_successors`.
+    """
+    if successors is None:
+        W, Z, successors = segment_successors(X, Y, tol)
+    else:
+        W, Z = X, Y
+
+    x, y, points, starts, ends, edges, offsets = \
+        pslg_tables(W, Z, successors)
+    num_points = len(x)
+
+    poly_file = open(filename, "w", buffering = 1 << 20)
+    poly_file.write("{0} 2 0 1\n".format(num_points))
+
+    # Write out the PSLG points
+    _write_table(poly_file, "{0} {1} {2} {3}\n",
+                 [starts, x, y, points])
+
+    # Write out the PSLG edges
+    poly_file.write("{0} 1\n".format(num_points))
+    _write_table(poly_file, "{0} {1} {2} {3}\n",
+                 [starts, starts, ends, edges + 1])
 
     # Write out the PSLG holes
     xh, yh = identify_holes(W, Z, successors)
@@ -204,53 +425,161 @@ def write_to_triangle(filename, X, Y, tol = 1000.0):
     poly_file.close()
 
 
-# ------------------------------------
-def write_to_geo(filename, X, Y, tol = 1000.0):
+# -----------------------------------------------------------
+@instrument.timed("mesh.write_to_geo")
+def write_to_geo(filename, X, Y, tol = 1000.0, successors = None,
+                 size_field = None):
     """
     Write out the PSLG to the gmsh .geo format
-    """
-    W, Z, successors = segment_successors(X, Y)
 
-    num_segments = len(W)
-    num_points = sum([len(w) for w in W])
+    If `successors` is given, `X, Y` are taken to be the already oriented
+    segments returned along with it by `segment_successors`.
+
+    By default the mesh size isn't set, and gmsh meshes as coarsely as the
+    boundary allows. If a `SizeField` `size_field` is given, each point
+    gets its characteristic length from it, and it's written out next to
+    the .geo file, with "_size.bin" in place of the extension, and used as
+    the background mesh size.
+    """
+    if successors is None:
+        W, Z, successors = segment_successors(X, Y, tol)
+    else:
+        W, Z = X, Y
 
-    geo_file = open(filename, "w")
+    x, y, points, starts, ends, edges, offsets = \
+        pslg_tables(W, Z, successors)
 
-    geo_file.write("cl = 1.0e+22;\n")
+    geo_file = open(filename, "w", buffering = 1 << 20)
 
     # Write out the PSLG points
-    counter = 1
-    for k in range(num_segments):
-        w, z = W[k], Z[k]
+    if size_field is None:
+        geo_file.write("cl = 1.0e+22;\n")
+        _write_table(geo_file, "Point({0}) = {{{1}, {2}, 0.0, cl}};\n",
+                     [starts, x, y])
+    else:
+        _write_table(geo_file, "Point({0}) = {{{1}, {2}, 0.0, {3}}};\n",
+                     [starts, x, y, size_field(x, y)])
 
-        for i in range(len(w)):
-            geo_file.write("Point({0}) = {{{1}, {2}, 0.0, cl}};\n"
-                           .format(counter + i, w[i], z[i]))
+    # Write out the PSLG edges
+    _write_table(geo_file, "Line({0}) = {{{1}, {2}}};\n",
+                 [starts, starts, ends])
 
-        counter += len(w)
+    if size_field is not None:
+        size_filename = os.path.splitext(filename)[0] + "_size.bin"
+        size_field.write_structured(size_filename)
+        geo_file.write(size_field.geo_commands(os.path.basename(size_filename)))
 
+    geo_file.close()
 
-    # Write out the PSLG edges
-    offsets = zeros(num_segments + 1, dtype = int)
-    offsets[0] = 1
-    for k in range(num_segments):
-        offsets[k + 1] = offsets[k] + len(W[k])
 
-    counter = 1
+# -----------------------------------------------------------
+@instrument.timed("mesh.write_to_msh")
+def write_to_msh(filename, X, Y, tol = 1000.0, successors = None):
+    """
+    Write out the PSLG to the binary gmsh MSH 4.1 format, as 2-node line
+    elements. Each segment becomes its own curve entity, numbered from 1.
+
+    If `successors` is given, `X, Y` are taken to be the already oriented
+    segments returned along with it by `segment_successors`.
+    """
+    if successors is None:
+        W, Z, successors = segment_successors(X, Y, tol)
+    else:
+        W, Z = X, Y
+
+    x, y, points, starts, ends, edges, offsets = \
+        pslg_tables(W, Z, successors)
+    num_segments = len(W)
+    num_points = len(x)
+
+    size_t = np.dtype("<u8")
+    integer = np.dtype("<i4")
+
+    msh_file = open(filename, "wb", buffering = 1 << 20)
+    msh_file.write(b"$MeshFormat\n4.1 1 8\n")
+    msh_file.write(np.array([1], dtype = integer).tobytes())
+    msh_file.write(b"\n$EndMeshFormat\n")
+
+    # Write out one curve entity per segment, with its bounding box
+    msh_file.write(b"$Entities\n")
+    msh_file.write(np.array([0, num_segments, 0, 0], dtype = size_t).tobytes())
     for k in range(num_segments):
-        w, z = W[k], Z[k]
+        a, b = offsets[k] - 1, offsets[k + 1] - 1
+        box = [x[a:b].min(), y[a:b].min(), 0.0, x[a:b].max(), y[a:b].max(), 0.0]
+        msh_file.write(np.array([k + 1], dtype = integer).tobytes())
+        msh_file.write(np.array(box, dtype = "<f8").tobytes())
+        msh_file.write(np.array([0, 0], dtype = size_t).tobytes())
+    msh_file.write(b"\n$EndEntities\n")
+
+    # Write out the PSLG points, one block per segment
+    msh_file.write(b"$Nodes\n")
+    msh_file.write(np.array([num_segments, num_points, 1, num_points],
+                            dtype = size_t).tobytes())
+    coords = np.column_stack((x, y, np.zeros(num_points))).astype("<f8")
+    for k in range(num_segments):
+        a, b = offsets[k] - 1, offsets[k + 1] - 1
+        msh_file.write(np.array([1, k + 1, 0], dtype = integer).tobytes())
+        msh_file.write(np.array([b - a], dtype = size_t).tobytes())
+        msh_file.write(starts[a:b].astype(size_t).tobytes())
+        msh_file.write(coords[a:b].tobytes())
+    msh_file.write(b"\n$EndNodes\n")
+
+    # Write out the PSLG edges, one block per segment
+    msh_file.write(b"$Elements\n")
+    msh_file.write(np.array([num_segments, num_points, 1, num_points],
+                            dtype = size_t).tobytes())
+    elements = np.column_stack((starts, starts, ends)).astype(size_t)
+    for k in range(num_segments):
+        a, b = offsets[k] - 1, offsets[k + 1] - 1
+        msh_file.write(np.array([1, k + 1, 1], dtype = integer).tobytes())
+        msh_file.write(np.array([b - a], dtype = size_t).tobytes())
+        msh_file.write(elements[a:b].tobytes())
+    msh_file.write(b"\n$EndElements\n")
 
-        for i in range(len(w) - 1):
-            geo_file.write("Line({0}) = {{{1}, {2}}};\n"
-                           .format(counter + i,
-                                   offsets[k] + i,
-                                   offsets[k] + i + 1))
+    msh_file.close()
 
-        l = successors[k]
-        geo_file.write("Line({0}) = {{{1}, {2}}};\n"
-                       .format(counter + len(w) - 1,
-                               offsets[k] + len(w) - 1,
-                               offsets[l]))
 
-        counter += len(w)
+# -----------------------------------------------------------
+@instrument.timed("mesh.write_to_npz")
+def write_to_npz(filename, X, Y, tol = 1000.0, successors = None):
+    """
+    Write out the PSLG to a numpy .npz archive, which `read_npz` loads back
+    without any parsing. Unlike the text formats, points are numbered from
+    0 here.
+
+    The archive holds the arrays
+    points:  (num_points, 2) coordinates of the points
+    edges:   (num_points, 2) the points each edge joins
+    markers: the segment each point, and each edge, belongs to
+    holes:   (num_holes, 2) a point inside each hole
+
+    If `successors` is given, `X, Y` are taken to be the already oriented
+    segments returned along with it by `segment_successors`.
+    """
+    if successors is None:
+        W, Z, successors = segment_successors(X, Y, tol)
+    else:
+        W, Z = X, Y
+
+    x, y, points, starts, ends, edges, offsets = \
+        pslg_tables(W, Z, successors)
+    xh, yh = identify_holes(W, Z, successors)
+
+    np.savez(filename,
+             points = np.column_stack((x, y)),
+             edges = np.column_stack((starts - 1, ends - 1)),
+             markers = edges,
+             holes = np.column_stack((xh, yh)).reshape(-1, 2))
 
+
+# ----------------------
+def read_npz(filename):
+    """
+    Read a PSLG written by `write_to_npz`
+
+    Returns:
+    =======
+    points, edges, markers, holes: see `write_to_npz`
+    """
+    with np.load(filename) as data:
+        return data["points"], data["edges"], data["markers"], data["holes"]
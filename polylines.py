@@ -0,0 +1,148 @@
+import numpy as np
+
+from read_shp import read_shapefiles_arrays
+
+
+class Polylines(object):
+    """
+    A collection of polylines stored as a single array of points, with the
+    points of line `k` in coords[offsets[k]: offsets[k+1]].
+
+    Each line also has a flag saying whether it's reversed; reversing a line
+    only flips the flag, and the points are returned in the right order as
+    a reversed view rather than being copied.
+
+    Parameters:
+    ==========
+    coords:   (num_points, 2) array of the coordinates of all the points
+    offsets:  array of num_lines + 1 offsets into `coords`
+    reversed: optional; reversed[k] = True if line `k` runs backwards
+    """
+
+    def __init__(self, coords, offsets, reversed = None):
+        self.coords = np.asarray(coords, dtype = np.float64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+
+        if reversed is None:
+            reversed = np.zeros(len(self.offsets) - 1, dtype = bool)
+        self.reversed = np.asarray(reversed, dtype = bool)
+
+    @classmethod
+    def from_lists(cls, X, Y):
+        """
+        Make a collection from the list-of-lines `X, Y`
+        """
+        lengths = [len(x) for x in X]
+        offsets = np.zeros(len(X) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(lengths)
+
+        coords = np.zeros((offsets[-1], 2))
+        for k in range(len(X)):
+            coords[offsets[k]: offsets[k + 1], 0] = X[k]
+            coords[offsets[k]: offsets[k + 1], 1] = Y[k]
+
+        return cls(coords, offsets)
+
+    @classmethod
+    def read(cls, filenames, workers = None):
+        """
+        Read every shape in a shapefile, or in a list of shapefiles, as one
+        line each
+        """
+        if isinstance(filenames, str):
+            filenames = [filenames]
+
+        coords, offsets = read_shapefiles_arrays(filenames, workers)
+
+        return cls(coords, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        """
+        Get the points of line `k` as a view of `coords`, or a slice of the
+        lines as a new collection sharing the same points
+        """
+        if isinstance(k, slice):
+            start, stop, step = k.indices(len(self))
+            if step != 1:
+                raise ValueError("Polylines can only be sliced contiguously")
+            stop = max(start, stop)
+
+            a, b = self.offsets[start], self.offsets[stop]
+            return Polylines(self.coords[a: b],
+                             self.offsets[start: stop + 1] - a,
+                             self.reversed[start: stop])
+
+        if k < 0:
+            k += len(self)
+        if k < 0 or k >= len(self):
+            raise IndexError("Polylines index out of range")
+
+        line = self.coords[self.offsets[k]: self.offsets[k + 1]]
+        if self.reversed[k]:
+            return line[::-1]
+
+        return line
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def lengths(self):
+        """
+        Return the number of points in each line
+        """
+        return np.diff(self.offsets)
+
+    def reverse(self, k):
+        """
+        Reverse the direction of line `k`
+        """
+        self.reversed[k] = not self.reversed[k]
+
+    def heads(self):
+        """
+        Return the (num_lines, 2) array of the first point of each line
+        """
+        first = self.coords[self.offsets[:-1]]
+        last = self.coords[self.offsets[1:] - 1]
+
+        return np.where(self.reversed[:, np.newaxis], last, first)
+
+    def tails(self):
+        """
+        Return the (num_lines, 2) array of the last point of each line
+        """
+        first = self.coords[self.offsets[:-1]]
+        last = self.coords[self.offsets[1:] - 1]
+
+        return np.where(self.reversed[:, np.newaxis], first, last)
+
+    def split(self):
+        """
+        Return the lines in the list-of-lines form `X, Y` the rest of the
+        code uses, as views of `coords`
+        """
+        X = [line[:, 0] for line in self]
+        Y = [line[:, 1] for line in self]
+
+        return X, Y
+
+    def to_parts(self):
+        """
+        Return the lines as lists of `[x, y]` pairs, as taken by the `parts`
+        argument of a shapefile writer
+        """
+        return [line.tolist() for line in self]
+
+    def compact(self):
+        """
+        Return a copy of the collection with the reversed lines' points
+        stored in order, e.g. before handing `coords` to code that doesn't
+        know about the reversal flags
+        """
+        coords = np.concatenate([np.zeros((0, 2))] + list(self))
+
+        return Polylines(coords, self.offsets - self.offsets[0])
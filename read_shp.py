@@ -1,6 +1,7 @@
 
 import numpy as np
 from shapefile import *
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------------------------
 def read_shapefile(filename):
@@ -37,3 +38,137 @@ def read_shapefiles(filenames):
         Y.extend(y)
 
     return X, Y
+
+
+# Shape types whose records hold a bounding box, parts and points, as
+# opposed to multipoints, which have no parts, and single points; the
+# parts of a multipatch are followed by an array of their types
+_poly_types = set([3, 5, 13, 15, 23, 25, 31])
+_multipatch_type = 31
+_multipoint_types = set([8, 18, 28])
+_point_types = set([1, 11, 21])
+
+
+# ----------------------------------
+def read_shapefile_arrays(filename):
+    """
+    Read every shape in a shapefile straight out of the .shp file, without
+    creating a Python object for each point.
+
+    Parameters:
+    ==========
+    filename: name of the shapefile, with or without the .shp extension
+
+    Returns:
+    =======
+    coords:  (num_points, 2) array of the coordinates of all the points of
+             all the shapes, one after the other
+    offsets: the points of shape `k` are coords[offsets[k]: offsets[k+1]];
+             shapes with no points are left out, as in `read_shapefile`
+    """
+    if filename[-4:] != ".shp":
+        filename = filename + ".shp"
+
+    shp_file = open(filename, "rb")
+    raw_data = shp_file.read()
+    shp_file.close()
+
+    le_int = np.dtype("<i4")
+    be_int = np.dtype(">i4")
+    le_double = np.dtype("<f8")
+
+    chunks = []
+    lengths = []
+
+    # Skip the 100-byte file header; each record has an 8-byte header
+    # holding, in big-endian, the record number and the length of its
+    # contents in 16-bit words
+    pos = 100
+    while pos + 8 <= len(raw_data):
+        length = 2 * int(np.frombuffer(raw_data, be_int, 1, pos + 4)[0])
+        content = pos + 8
+        pos = content + length
+
+        shape_type = int(np.frombuffer(raw_data, le_int, 1, content)[0])
+
+        if shape_type in _poly_types:
+            num_parts, num_points = np.frombuffer(raw_data, le_int, 2,
+                                                  content + 36)
+            start = content + 44 + 4 * num_parts
+            if shape_type == _multipatch_type:
+                start += 4 * num_parts
+        elif shape_type in _multipoint_types:
+            num_points = np.frombuffer(raw_data, le_int, 1, content + 36)[0]
+            start = content + 40
+        elif shape_type in _point_types:
+            num_points = 1
+            start = content + 4
+        else:
+            continue
+
+        if num_points > 0:
+            points = np.frombuffer(raw_data, le_double, 2 * num_points, start)
+            chunks.append(points)
+            lengths.append(num_points)
+
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    if chunks:
+        coords = np.concatenate(chunks).reshape(-1, 2)
+    else:
+        coords = np.zeros((0, 2))
+
+    return coords, offsets
+
+
+# ---------------------------------------------------------
+def read_shapefiles_arrays(filenames, workers = None):
+    """
+    Read several shapefiles at once on a pool of threads, and stack all of
+    their shapes together.
+
+    Parameters:
+    ==========
+    filenames: names of the shapefiles
+    workers:   optional; number of threads, by default chosen by
+               `ThreadPoolExecutor`
+
+    Returns:
+    =======
+    coords, offsets: same as for `read_shapefile_arrays`, with the shapes
+                     in the order of `filenames`
+    """
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        results = list(executor.map(read_shapefile_arrays, filenames))
+
+    coords = np.concatenate([np.zeros((0, 2))] + [c for c, o in results])
+
+    offsets = [np.zeros(1, dtype = np.int64)]
+    total = 0
+    for c, o in results:
+        offsets.append(o[1:] + total)
+        total += len(c)
+
+    return coords, np.concatenate(offsets)
+
+
+# --------------------------------
+def split_lines(coords, offsets):
+    """
+    Split the points `coords` into separate lines at `offsets`, in the
+    list-of-lines form the rest of the code uses; each line is a view of
+    `coords` rather than a copy
+
+    Returns:
+    =======
+    X, Y: lists of arrays of the coordinates of each line
+    """
+    X = []
+    Y = []
+
+    for k in range(len(offsets) - 1):
+        X.append(coords[offsets[k]: offsets[k + 1], 0])
+        Y.append(coords[offsets[k]: offsets[k + 1], 1])
+
+    return X, Y
@@ -1,7 +1,8 @@
 
-from read_shp import read_shapefiles
-from mesh_fiddling import write_to_triangle, write_to_geo
-from streamlines import coarsen_streamline
+from polylines import Polylines
+from mesh_fiddling import polyline_successors, write_to_triangle, \
+    write_to_geo, write_to_msh, write_to_npz
+from streamlines import coarsen_lines
 import glob
 import sys
 
@@ -16,12 +17,17 @@ if __name__ == "__main__":
     # Get rid of any input that's not a shapefile
     input_filenames = [s for s in input_filenames if s[-4:] == ".shp"]
 
-    X, Y = read_shapefiles(input_filenames)
+    lines = Polylines.read(input_filenames)
+    lines = Polylines(*coarsen_lines(lines.coords, lines.offsets, 500.0))
 
-    for k in range(len(X)):
-        X[k], Y[k] = coarsen_streamline(X[k], Y[k], 500.0)
+    lines, successors = polyline_successors(lines)
+    X, Y = lines.split()
 
     if output_filename[-5:] == ".poly":
-        write_to_triangle(output_filename, X, Y)
+        write_to_triangle(output_filename, X, Y, successors = successors)
+    elif output_filename[-4:] == ".msh":
+        write_to_msh(output_filename, X, Y, successors = successors)
+    elif output_filename[-4:] == ".npz":
+        write_to_npz(output_filename, X, Y, successors = successors)
     else:
-        write_to_geo(output_filename, X, Y)
+        write_to_geo(output_filename, X, Y, successors = successors)
@@ -0,0 +1,140 @@
+import numpy as np
+from scipy import ndimage
+
+from interpolator import Interpolator
+
+
+# ----------------------------------------------------------------
+def _scale(q, low, high, min_length, max_length):
+    """
+    Map the field `q` to a characteristic length that goes from
+    `max_length` where `q` <= `low` to `min_length` where `q` >= `high`,
+    geometrically in between, so that each doubling of `q` shrinks the
+    length by the same factor
+    """
+    q = np.maximum(q, low)
+    t = np.clip(np.log(q / low) / np.log(high / low), 0.0, 1.0)
+
+    return max_length * (min_length / max_length)**t
+
+
+class SizeField(object):
+    """
+    A characteristic length for the mesh, defined on a regular grid, that
+    can be evaluated at the points of a PSLG and written out as a gmsh
+    background field.
+
+    Parameters:
+    ==========
+    x, y:       the grid coordinates
+    cl:         array of shape `(len(y), len(x))` of the characteristic
+                length at each grid point
+    max_length: the length used off the grid
+    """
+
+    def __init__(self, x, y, cl, max_length):
+        self.x = np.asarray(x, dtype = np.float64)
+        self.y = np.asarray(y, dtype = np.float64)
+        self.cl = cl
+        self.max_length = max_length
+
+    @classmethod
+    def from_speed(cls, x, y, speed, min_length, max_length,
+                   slow = 10.0, fast = 1000.0, valid = None):
+        """
+        Make a size field that's `max_length` where the ice flows at
+        `slow` or less and `min_length` where it flows at `fast` or more,
+        e.g. from `VelocityField.magnitude`
+
+        Parameters:
+        ==========
+        x, y:       the grid coordinates
+        speed:      the speed of the ice at each grid point
+        min_length, max_length: the range of characteristic lengths
+        slow, fast: optional; the speeds at which each is reached
+        valid:      optional; boolean array, True where there are data;
+                    `max_length` is used everywhere else
+        """
+        cl = _scale(speed, slow, fast, min_length, max_length)
+        if valid is not None:
+            cl[~valid] = max_length
+
+        return cls(x, y, cl, max_length)
+
+    @classmethod
+    def from_strain_rate(cls, x, y, vx, vy, min_length, max_length,
+                         low = 1.0e-3, high = 1.0e-1, valid = None):
+        """
+        Same as `from_speed`, but from the effective strain rate of the
+        velocities `vx`, `vy`, in units of 1 / the time unit of the
+        velocities, so that the mesh is fine where the flow changes
+        quickly, e.g. in shear margins, rather than wherever it's fast.
+
+        The strain rate isn't computed at points next to missing data,
+        which get `max_length`.
+        """
+        dx = x[1] - x[0]
+        dy = y[1] - y[0]
+
+        dvx_dy, dvx_dx = np.gradient(np.asarray(vx, dtype = np.float64),
+                                     dy, dx)
+        dvy_dy, dvy_dx = np.gradient(np.asarray(vy, dtype = np.float64),
+                                     dy, dx)
+
+        # Second invariant of the strain rate tensor, with the vertical
+        # strain rate given by incompressibility
+        exx = dvx_dx
+        eyy = dvy_dy
+        exy = 0.5 * (dvx_dy + dvy_dx)
+        strain_rate = np.sqrt(0.5 * (exx**2 + eyy**2 + (exx + eyy)**2)
+                              + exy**2)
+
+        cl = _scale(strain_rate, low, high, min_length, max_length)
+        if valid is not None:
+            cl[~ndimage.binary_erosion(valid, border_value = 1)] = max_length
+
+        return cls(x, y, cl, max_length)
+
+    def __call__(self, X, Y):
+        """
+        Return the characteristic length at the points `X`, `Y`
+        """
+        p, inside = Interpolator(self.x, self.y, self.cl)(X, Y,
+                                                          self.max_length)
+
+        return p[:, 0]
+
+    def write_structured(self, filename):
+        """
+        Write the size field out to a binary file that gmsh can read as a
+        `Structured` field with TextFormat = 0: the origin, the grid
+        spacing and the number of points in each direction, then the
+        values with the x-index varying slowest and the z-index fastest.
+
+        The grid is given two layers, at z = -1 and z = 1, with the same
+        values, so that the mesh, at z = 0, is inside it.
+        """
+        header = np.array([self.x[0], self.y[0], -1.0,
+                           self.x[1] - self.x[0], self.y[1] - self.y[0], 2.0])
+        n = np.array([len(self.x), len(self.y), 2], dtype = np.int32)
+        values = np.repeat(self.cl.T[:, :, np.newaxis], 2, axis = 2)
+
+        with open(filename, "wb") as size_file:
+            size_file.write(header.astype(np.float64).tobytes())
+            size_file.write(n.tobytes())
+            size_file.write(values.astype(np.float64).tobytes())
+
+    def geo_commands(self, filename, field = 1):
+        """
+        Return the .geo commands that load the size field written to
+        `filename` by `write_structured` as gmsh field number `field`, and
+        use it as the background mesh size
+        """
+        return ("Field[{0}] = Structured;\n"
+                "Field[{0}].FileName = \"{1}\";\n"
+                "Field[{0}].TextFormat = 0;\n"
+                "Field[{0}].SetOutsideValue = 1;\n"
+                "Field[{0}].OutsideValue = {2};\n"
+                "Background Field = {0};\n"
+                "Mesh.CharacteristicLengthExtendFromBoundary = 0;\n"
+                .format(field, filename, self.max_length))
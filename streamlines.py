@@ -1,6 +1,13 @@
 import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from shapefile import *
-from geodat import read_geodat
+from velocity import VelocityField
+from interpolator import Interpolator
+from polylines import Polylines
+import instrument
+import kernels
 
 # -------------------------------
 def interpolate(x, y, x0, y0, q):
@@ -26,15 +33,299 @@ def interpolate(x, y, x0, y0, q):
     return p
 
 
-# ---------------------------------------------
-def streamline(x, y, vx, vy, x0, y0, sign = 1):
+# ---------------------------------------
+def interpolate_points(x, y, X0, Y0, q):
+    """
+    Interpolate the value of the field `q` defined on the grid `x`, `y`
+    to each of the points `X0`, `Y0`
+
+    Returns:
+    =======
+    p:      the interpolated values; 0 at points outside the grid
+    inside: inside[k] = True if point `k` is inside the grid
+    """
+    p, inside = Interpolator(x, y, q)(X0, Y0)
+
+    return p[:, 0], inside
+
+
+# Butcher tableaux of the Runge-Kutta methods available for streamlines:
+# stage coefficients, weights, and the weights of the embedded lower-order
+# method used to estimate the error, if any
+rk4_tableau = ( [ [],
+                  [0.5],
+                  [0.0, 0.5],
+                  [0.0, 0.0, 1.0] ],
+                [1.0/6, 1.0/3, 1.0/3, 1.0/6],
+                None )
+
+# Dormand-Prince 5(4); the last stage is evaluated at the new point, so the
+# velocity found there is used again for the first stage of the next step
+rk45_tableau = ( [ [],
+                   [1.0/5],
+                   [3.0/40, 9.0/40],
+                   [44.0/45, -56.0/15, 32.0/9],
+                   [19372.0/6561, -25360.0/2187, 64448.0/6561, -212.0/729],
+                   [9017.0/3168, -355.0/33, 46732.0/5247, 49.0/176,
+                    -5103.0/18656],
+                   [35.0/384, 0.0, 500.0/1113, 125.0/192, -2187.0/6784,
+                    11.0/84] ],
+                 [35.0/384, 0.0, 500.0/1113, 125.0/192, -2187.0/6784,
+                  11.0/84, 0.0],
+                 [5179.0/57600, 0.0, 7571.0/16695, 393.0/640,
+                  -92097.0/339200, 187.0/2100, 1.0/40] )
+
+
+# ---------------------------------
+def _first_same_as_last(tableau):
+    """
+    Return True if the last stage of a Runge-Kutta method is evaluated at
+    the new point, so the velocity there doesn't have to be interpolated
+    again for the next step
+    """
+    A, b, b_err = tableau
+
+    return b[-1] == 0.0 and list(A[-1]) == list(b[:-1])
+
+
+# -----------------------------------
+def _velocity(interpolator, X0, Y0):
+    """
+    Interpolate both velocity components to the points `X0`, `Y0`
+    """
+    instrument.count("streamlines.interpolation_calls")
+    instrument.count("streamlines.points_interpolated", len(X0))
+
+    p, inside = interpolator(X0, Y0)
+    u = p[:, 0]
+    v = p[:, 1]
+
+    return u, v, np.sqrt(u**2 + v**2), inside
+
+
+# ---------------------------------------------------------------
+def _count_retired(stage_outside, outside, slow, total):
+    """
+    Count the streamlines stopped for each reason, out of `total` stopped:
+    an intermediate stage left the grid, the line itself left the grid,
+    it slowed down too much, or, for the rest, it hit the step limit
+    """
+    instrument.count("streamlines.retired.stage_outside", stage_outside)
+    instrument.count("streamlines.retired.outside", outside)
+    instrument.count("streamlines.retired.slow", slow)
+    instrument.count("streamlines.retired.max_steps",
+                     total - stage_outside - outside - slow)
+
+
+# ---------------------------------------------------------
+@instrument.timed("streamlines.trace")
+def streamlines_batch(x, y, vx, vy, X0, Y0, sign = 1,
+                      min_speed = 5.0, max_steps = 10000, step = 50.0,
+                      method = "euler", tol = 1.0,
+                      min_step = 1.0, max_step = 1000.0,
+                      interpolator = None):
+    """
+    Generate the streamlines originating at each of the points `X0`, `Y0`
+    at once, advancing all of them together.
+
+    A streamline stops when the speed drops below `min_speed`, when it
+    leaves the grid, or after `max_steps` steps; the point at which it
+    stopped is the last one in the line. The higher-order methods also stop
+    a streamline at its current point if one of their intermediate stages
+    lands outside the grid.
+
+    Parameters:
+    ==========
+    x, y, vx, vy, sign: same as for `streamline`
+    X0, Y0:    arrays of starting coordinates of the streamlines
+    min_speed: optional; speed below which a streamline stops
+    max_steps: optional; maximum number of steps along any streamline
+    step:      optional; arc length of each step, or of the first step for
+               the adaptive method
+    method:    optional; "euler" for forward Euler, "rk4" for the classical
+               4th-order Runge-Kutta method, or "rk45" for the adaptive
+               Dormand-Prince method
+    tol:       optional; the largest error in position, in meters, that
+               "rk45" allows in a single step
+    min_step, max_step: optional; bounds on the step size for "rk45"
+    interpolator: optional; an `Interpolator` of `vx`, `vy` on the grid
+               `x`, `y`, so that several batches can share one
+
+    If Numba is installed, "euler" and "rk4" run the compiled versions in
+    `kernels` instead, which give the same numbers and are counted in the
+    same `instrument` counters.
+
+    Returns:
+    =======
+    lines: list of pairs `X, Y` of arrays of the coordinates of each
+           streamline
+    """
+    if method == "rk4":
+        tableau = rk4_tableau
+    elif method == "rk45":
+        tableau = rk45_tableau
+    elif method != "euler":
+        raise ValueError("Unknown integration method {0}".format(method))
+
+    if interpolator is None:
+        interpolator = Interpolator(x, y, vx, vy)
+
+    # The fixed-step methods have compiled versions, if Numba is installed
+    if kernels.use_numba() and method != "rk45":
+        Xs, Ys, offsets, reasons = kernels.trace_streamlines(
+            interpolator, X0, Y0, sign, min_speed, max_steps, step,
+            rk4_tableau if method == "rk4" else None)
+
+        if instrument.enabled:
+            # Count the velocity evaluations the numpy code below would
+            # have made: one round per step, of every stage for each line
+            # still going and then of each new point, where a line whose
+            # stage left the grid had one more round than it has steps
+            num_stages = 1 if method == "euler" else len(rk4_tableau[1])
+            attempts = np.diff(offsets) - 1 + \
+                (reasons == kernels.STAGE_OUTSIDE)
+            rounds = attempts.max() if len(attempts) > 0 else 0
+
+            instrument.count("streamlines.interpolation_calls",
+                             int(1 + num_stages * rounds))
+            instrument.count("streamlines.points_interpolated",
+                             int(len(X0) + (num_stages - 1) * attempts.sum()
+                                 + len(Xs) - len(X0)))
+
+            instrument.count("streamlines.steps", len(Xs) - len(X0))
+            stopped = np.bincount(reasons, minlength = 4)
+            _count_retired(stopped[kernels.STAGE_OUTSIDE],
+                           stopped[kernels.OUTSIDE], stopped[kernels.SLOW],
+                           len(X0))
+
+        return [ (Xs[offsets[n]: offsets[n + 1]], Ys[offsets[n]: offsets[n + 1]])
+                 for n in range(len(X0)) ]
+
+    xs = np.array(X0, dtype = np.float64)
+    ys = np.array(Y0, dtype = np.float64)
+    num_seeds = len(xs)
+
+    u, v, speed, inside = _velocity(interpolator, xs, ys)
+    h = np.zeros(num_seeds) + step
+    steps = np.zeros(num_seeds, dtype = int)
+
+    # Keep track of every point added to each line, along with which seed
+    # it came from, and sort them out into separate lines at the end
+    seeds = [ np.arange(num_seeds) ]
+    Xs = [ xs.copy() ]
+    Ys = [ ys.copy() ]
+
+    active = np.where(inside & (speed > min_speed))[0]
+
+    if instrument.enabled:
+        outside = np.count_nonzero(~inside)
+        _count_retired(0, outside, num_seeds - len(active) - outside,
+                       num_seeds - len(active))
+
+    while (len(active) > 0):
+        if method == "euler":
+            dt = sign * step / speed[active]
+
+            xs[active] = xs[active] + dt * u[active]
+            ys[active] = ys[active] + dt * v[active]
+            moved = active
+            stopped = np.zeros(len(active), dtype = bool)
+        else:
+            A, b, b_err = tableau
+            ha = h[active]
+
+            # The streamline is parametrized by arc length, so each stage
+            # evaluates the unit vector along the flow
+            kx = [ sign * u[active] / speed[active] ]
+            ky = [ sign * v[active] / speed[active] ]
+            ok = np.ones(len(active), dtype = bool)
+
+            for a in A[1:]:
+                px = xs[active] + ha * sum(c * k for c, k in zip(a, kx))
+                py = ys[active] + ha * sum(c * k for c, k in zip(a, ky))
+                pu, pv, ps, pin = _velocity(interpolator, px, py)
+                last = (pu, pv, ps, pin)
+
+                ok &= pin & (ps > 0.0)
+                ps = np.where(ps > 0.0, ps, 1.0)
+                kx.append(sign * pu / ps)
+                ky.append(sign * pv / ps)
+
+            stopped = ~ok
+            accept = ok.copy()
+
+            if b_err is not None:
+                ex = ha * sum((c - e) * k for c, e, k in zip(b, b_err, kx))
+                ey = ha * sum((c - e) * k for c, e, k in zip(b, b_err, ky))
+                err = np.sqrt(ex**2 + ey**2)
+
+                accept &= (err <= tol) | (ha <= min_step)
+
+                # Standard step size control, with the factor by which the
+                # step can change limited to [0.2, 5]
+                factor = 0.9 * (tol / np.maximum(err, 1.0e-12 * tol))**0.2
+                factor = np.clip(factor, 0.2, 5.0)
+                h[active] = np.clip(ha * factor, min_step, max_step)
+
+            moved = active[accept]
+            ha = ha[accept]
+            xs[moved] = xs[moved] + ha * sum(c * k[accept] for c, k in zip(b, kx))
+            ys[moved] = ys[moved] + ha * sum(c * k[accept] for c, k in zip(b, ky))
+
+        steps[moved] += 1
+        instrument.count("streamlines.steps", len(moved))
+
+        seeds.append(moved)
+        Xs.append(xs[moved])
+        Ys.append(ys[moved])
+
+        if method != "euler" and _first_same_as_last(tableau):
+            pu, pv, ps, pin = last
+            u[moved], v[moved], speed[moved] = \
+                pu[accept], pv[accept], ps[accept]
+            inside = pin[accept]
+        else:
+            u[moved], v[moved], speed[moved], inside = \
+                _velocity(interpolator, xs[moved], ys[moved])
+
+        done = np.zeros(num_seeds, dtype = bool)
+        done[active[stopped]] = True
+        done[moved[~inside | (speed[moved] <= min_speed)]] = True
+        done[steps >= max_steps] = True
+
+        if instrument.enabled:
+            _count_retired(np.count_nonzero(stopped),
+                           np.count_nonzero(~inside),
+                           np.count_nonzero(inside &
+                                            (speed[moved] <= min_speed)),
+                           np.count_nonzero(done[active]))
+
+        active = active[~done[active]]
+
+    seeds = np.concatenate(seeds)
+    Xs = np.concatenate(Xs)
+    Ys = np.concatenate(Ys)
+
+    order = np.argsort(seeds, kind = "mergesort")
+    offsets = np.searchsorted(seeds[order], np.arange(num_seeds + 1))
+    Xs = Xs[order]
+    Ys = Ys[order]
+
+    return [ (Xs[offsets[n]: offsets[n + 1]], Ys[offsets[n]: offsets[n + 1]])
+             for n in range(num_seeds) ]
+
+
+# ------------------------------------------------------------------
+def streamline(x, y, vx, vy, x0, y0, sign = 1, method = "euler", tol = 1.0):
     """
     Given the x/y velocity fields `vx`, `vy`, defined at the grid points
     `x`, `y`, generate a streamline originating at the point `x0`, `y0`.
     The streamline will go backwards if the optional argument `sign` = -1.
 
-    The algorithm we use is an adaptive forward Euler method. It's not very
-    good. Willie hears ye; Willie don't care.
+    By default the algorithm we use is an adaptive forward Euler method.
+    It's not very good. Willie hears ye; Willie don't care. The classical
+    Runge-Kutta method or the adaptive Dormand-Prince method can be used
+    instead; see `streamlines_batch`.
 
     Parameters:
     ==========
@@ -42,74 +333,591 @@ def streamline(x, y, vx, vy, x0, y0, sign = 1):
     vx, vy: velocities in the x, y directions
     x0, y0: starting coordinate of the streamline
     sign: optional; =1 if the streamline is forward, -1 if backward
+    method: optional; "euler", "rk4" or "rk45"
+    tol: optional; error tolerance, in meters, for "rk45"
 
     Returns:
     =======
     X, Y: coordinates of the resultant streamline
     """
-    nx = len(x)
-    ny = len(y)
+    X, Y = streamlines_batch(x, y, vx, vy, [x0], [y0], sign,
+                             method = method, tol = tol)[0]
 
-    u = interpolate(x, y, x0, y0, vx)
-    v = interpolate(x, y, x0, y0, vy)
+    return list(X), list(Y)
 
-    speed = np.sqrt(u**2 + v**2)
 
-    X = [ x0 ]
-    Y = [ y0 ]
+# The velocity interpolator of each worker process in
+# `streamlines_parallel`, attached to the shared memory once per process
+_worker_memory = []
+_worker_interpolator = None
 
-    k = 0
 
-    while (speed > 5.0 and k < 10000):
-        k += 1
-        dt = sign * 50.0 / speed
+# -------------------
+def _share(q):
+    """
+    Copy the array `q` into a new block of shared memory
+
+    Returns:
+    =======
+    memory: the shared memory block
+    spec:   the name, shape and type of the array, for `_attach`
+    """
+    memory = shared_memory.SharedMemory(create = True,
+                                        size = max(q.nbytes, 1))
+    shared = np.ndarray(q.shape, dtype = q.dtype, buffer = memory.buf)
+    shared[...] = q
+
+    return memory, (memory.name, q.shape, q.dtype)
+
+
+# -----------------
+def _attach(spec):
+    name, shape, dtype = spec
+    memory = shared_memory.SharedMemory(name = name)
+    _worker_memory.append(memory)
+
+    return np.ndarray(shape, dtype = dtype, buffer = memory.buf)
 
-        x0 = x0 + dt * u
-        y0 = y0 + dt * v
 
-        X.append(x0)
-        Y.append(y0)
+# -----------------------------------------------
+def _init_worker(q_spec, valid_spec, x, y, backend):
+    global _worker_interpolator
+
+    kernels.backend = backend
+    q = _attach(q_spec)
+    valid = _attach(valid_spec) if valid_spec is not None else None
+    _worker_interpolator = Interpolator.from_stacked(x, y, q, valid)
+
+
+# -----------------------
+def _trace_chunk(args):
+    X0, Y0, sign, kwargs = args
+
+    return streamlines_batch(None, None, None, None, X0, Y0, sign,
+                             interpolator = _worker_interpolator, **kwargs)
+
+
+# -------------------------------------------------------------
+def streamlines_parallel(x, y, vx, vy, X0, Y0, sign = 1,
+                         workers = None, chunk_size = 256,
+                         interpolator = None, **kwargs):
+    """
+    Generate the streamlines originating at each of the points `X0`, `Y0`
+    on a pool of processes.
+
+    The velocities are copied once into shared memory, which every worker
+    attaches to, and the seeds are handed out in chunks of `chunk_size`.
+    The workers are started fresh rather than forked, since forking after
+    the compiled kernels have run in parallel can leave them deadlocked;
+    so, as for any spawned processes, the main script has to be guarded by
+    `if __name__ == "__main__"`.
+
+    Parameters:
+    ==========
+    x, y, vx, vy, X0, Y0, sign: same as for `streamlines_batch`
+    workers:      optional; number of processes, by default one per core
+    chunk_size:   optional; number of seeds traced by a worker at a time
+    interpolator: optional; an `Interpolator` of `vx`, `vy`; if given, its
+                  stacked velocities, in their own type, and its mask are
+                  what's shared, so that the workers trace exactly the same
+                  field as `streamlines_batch` would with it
+    kwargs:       any other arguments to `streamlines_batch`
+
+    Returns:
+    =======
+    lines: list of pairs `X, Y` of arrays of the coordinates of each
+           streamline, in the same order as the seeds
+    """
+    if interpolator is None:
+        interpolator = Interpolator(x, y, vx, vy)
+
+    memory = []
+    try:
+        block, q_spec = _share(np.asarray(interpolator.q))
+        memory.append(block)
+
+        valid_spec = None
+        if interpolator.valid is not None:
+            block, valid_spec = _share(np.asarray(interpolator.valid))
+            memory.append(block)
+
+        chunks = [ (X0[n: n + chunk_size], Y0[n: n + chunk_size], sign, kwargs)
+                   for n in range(0, len(X0), chunk_size) ]
+
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers = workers,
+                                 mp_context = context,
+                                 initializer = _init_worker,
+                                 initargs = (q_spec, valid_spec,
+                                             interpolator.x, interpolator.y,
+                                             kernels.backend)) as executor:
+            lines = []
+            for result in executor.map(_trace_chunk, chunks):
+                lines.extend(result)
+    finally:
+        for block in memory:
+            block.close()
+            block.unlink()
+
+    return lines
+
+
+# ---------------------------------------
+def _decimate_by_distance(X, Y, res):
+    """
+    Return the indices of the points kept by distance decimation: each is
+    the first point more than `res` from the one kept before it
+    """
+    nn = len(X)
+    keep = [0]
+    k = 0
+    window = 64
+
+    while k < nn - 1:
+        # Look for the next point in a window after the last one kept,
+        # widening the window until we find it or run out of points
+        end = min(k + 1 + window, nn)
+        dist = np.sqrt((X[k + 1: end] - X[k])**2 + (Y[k + 1: end] - Y[k])**2)
+        far = np.flatnonzero(dist > res)
 
-        u = interpolate(x, y, x0, y0, vx)
-        v = interpolate(x, y, x0, y0, vy)
-        speed = np.sqrt(u**2 + v**2)
+        if len(far) > 0:
+            k = k + 1 + far[0]
+            keep.append(k)
+        elif end == nn:
+            break
+        else:
+            window *= 2
 
-    return X, Y
+    return np.array(keep)
 
 
 # --------------------------------
-def coarsen_streamline(X, Y, res):
+def _douglas_peucker(X, Y, tol):
+    """
+    Return the indices of the points kept by the Ramer-Douglas-Peucker
+    algorithm, so that no point is more than `tol` from the coarsened path
+    """
+    nn = len(X)
+    keep = np.zeros(nn, dtype = bool)
+    keep[0] = keep[-1] = True
+
+    stack = [ (0, nn - 1) ]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+
+        dx = X[j] - X[i]
+        dy = Y[j] - Y[i]
+        length = np.sqrt(dx**2 + dy**2)
+
+        wx = X[i + 1: j] - X[i]
+        wy = Y[i + 1: j] - Y[i]
+        if length > 0.0:
+            dist = np.abs(dx * wy - dy * wx) / length
+        else:
+            dist = np.sqrt(wx**2 + wy**2)
+
+        k = np.argmax(dist)
+        if dist[k] > tol:
+            k = i + 1 + k
+            keep[k] = True
+            stack.append( (i, k) )
+            stack.append( (k, j) )
+
+    return np.flatnonzero(keep)
+
+
+# -------------------------------------------------
+def _decimate_by_curvature(X, Y, res, max_angle):
+    """
+    Return the indices of the points kept by curvature-adaptive spacing:
+    points are spaced `res` apart along straight stretches, and at least one
+    is kept for every `max_angle` radians the path turns through
+    """
+    nn = len(X)
+    if nn < 3:
+        return np.arange(nn)
+
+    dx = np.diff(X)
+    dy = np.diff(Y)
+    ds = np.sqrt(dx**2 + dy**2)
+
+    turn = np.zeros(nn - 1)
+    turn[1:] = np.abs(np.arctan2(dx[:-1] * dy[1:] - dy[:-1] * dx[1:],
+                                 dx[:-1] * dx[1:] + dy[:-1] * dy[1:]))
+
+    # Measure the path by arc length plus turning, scaled so that turning
+    # through `max_angle` counts the same as going straight for `res`, and
+    # keep a point every time this measure passes a multiple of `res`
+    measure = np.zeros(nn)
+    measure[1:] = np.cumsum(ds + res * turn / max_angle)
+    level = np.floor(measure / res)
+
+    keep = np.flatnonzero(np.diff(level) > 0) + 1
+    keep = np.concatenate(([0], keep[keep < nn - 1], [nn - 1]))
+
+    return keep
+
+
+# ----------------------------------------------------------------------
+def coarsen_streamline(X, Y, res, method = "distance", tol = None,
+                       max_angle = np.pi / 6):
     """
     Parameters:
     ==========
-    x, y: coordinates of a path
-    res:  resolution of the coarsening
+    x, y:      coordinates of a path
+    res:       resolution of the coarsening
+    method:    optional; how to pick the points to keep:
+               "distance":  each point kept is the first more than `res`
+                            from the last one kept
+               "rdp":       Ramer-Douglas-Peucker, keeping the fewest points
+                            so that the path moves no more than `tol`
+               "curvature": points `res` apart along straight stretches,
+                            and closer together where the path turns
+    tol:       optional; tolerance for "rdp", by default `res` / 10
+    max_angle: optional; for "curvature", the most the path can turn
+               through between two kept points, in radians
 
     Returns:
     =======
     X, Y: coordinates of the coarsened path
     """
+    X = np.asarray(X, dtype = np.float64)
+    Y = np.asarray(Y, dtype = np.float64)
 
-    nn = len(X)
+    if len(X) == 0:
+        return [], []
+
+    if method == "distance":
+        keep = _decimate_by_distance(X, Y, res)
+    elif method == "rdp":
+        keep = _douglas_peucker(X, Y, 0.1 * res if tol is None else tol)
+    elif method == "curvature":
+        keep = _decimate_by_curvature(X, Y, res, max_angle)
+    else:
+        raise ValueError("Unknown coarsening method {0}".format(method))
+
+    return X[keep].tolist(), Y[keep].tolist()
+
+
+# -----------------------------------------------
+def coarsen_streamlines(X, Y, res, **kwargs):
+    """
+    Coarsen every path in the lists-of-lines `X, Y`; see
+    `coarsen_streamline` for the arguments
+
+    Returns:
+    =======
+    W, Z: lists of the coordinates of the coarsened paths
+    """
+    W = []
+    Z = []
+
+    for x, y in zip(X, Y):
+        w, z = coarsen_streamline(x, y, res, **kwargs)
+        W.append(w)
+        Z.append(z)
+
+    return W, Z
+
+
+# ----------------------------------------------
+def coarsen_lines(coords, offsets, res, **kwargs):
+    """
+    Coarsen every line of a batch stored as one array of points `coords`,
+    where line `k` is coords[offsets[k]: offsets[k+1]], as returned by
+    `read_shp.read_shapefile_arrays`; see `coarsen_streamline` for the
+    other arguments
+
+    Returns:
+    =======
+    coords, offsets: the coarsened lines, in the same layout
+    """
+    chunks = [ np.zeros((0, 2)) ]
+    lengths = []
+
+    for k in range(len(offsets) - 1):
+        line = coords[offsets[k]: offsets[k + 1]]
+        w, z = coarsen_streamline(line[:, 0], line[:, 1], res, **kwargs)
+        chunks.append(np.column_stack((w, z)).reshape(-1, 2))
+        lengths.append(len(w))
+
+    new_offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    new_offsets[1:] = np.cumsum(lengths)
+
+    return np.concatenate(chunks), new_offsets
+
+
+class OccupancyGrid(object):
+    """
+    The points of a set of streamlines, bucketed into square cells of side
+    `cell`, so that the distance from any point to the nearest of them can
+    be found by looking in no more than 9 cells, as long as that distance
+    is less than `cell`.
+
+    Only the points themselves are stored, sorted by the cell they're in,
+    so the memory used grows with the number of points rather than with
+    the number of cells.
+
+    Parameters:
+    ==========
+    x, y: the grid the streamlines are traced on
+    cell: the size of the cells
+    """
+
+    def __init__(self, x, y, cell):
+        self.xmin = x[0]
+        self.ymin = y[0]
+        self.cell = float(cell)
+        self.nx = int(np.ceil((x[-1] - x[0]) / cell)) + 1
+        self.ny = int(np.ceil((y[-1] - y[0]) / cell)) + 1
 
-    Xc = []
-    Yc = []
+        self.keys = np.zeros(0, dtype = np.int64)
+        self.points = np.zeros((0, 2))
 
-    Xc.append(X[0])
-    Yc.append(Y[0])
+    def _cells(self, X, Y):
+        i = np.floor((np.asarray(Y) - self.ymin) / self.cell).astype(int)
+        j = np.floor((np.asarray(X) - self.xmin) / self.cell).astype(int)
 
-    for i in range(1, nn):
-        # Should probably do some correction for the curvature
-        dist = np.sqrt((X[i] - Xc[-1])**2 + (Y[i] - Yc[-1])**2)
-        if dist > res:
-            Xc.append(X[i])
-            Yc.append(Y[i])
+        return np.clip(i, 0, self.ny - 1), np.clip(j, 0, self.nx - 1)
 
-    return Xc, Yc
+    def add(self, X, Y):
+        """
+        Add the points `X`, `Y` to the grid
+        """
+        i, j = self._cells(X, Y)
+        cells = (i * self.nx + j).astype(np.int64)
+
+        # Merge the new points in after the ones already in the same cells
+        order = np.argsort(cells, kind = "mergesort")
+        cells = cells[order]
+        where = np.searchsorted(self.keys, cells, side = "right")
+        points = np.column_stack((np.asarray(X, dtype = np.float64),
+                                  np.asarray(Y, dtype = np.float64)))[order]
+
+        self.keys = np.insert(self.keys, where, cells)
+        self.points = np.insert(self.points, where, points, axis = 0)
+
+    def distance(self, X, Y):
+        """
+        Return the distance from each of the points `X`, `Y` to the nearest
+        point in the grid, or infinity if there are none within `cell`
+        """
+        X = np.atleast_1d(np.asarray(X, dtype = np.float64))
+        Y = np.atleast_1d(np.asarray(Y, dtype = np.float64))
+        i, j = self._cells(X, Y)
+
+        I = i[:, np.newaxis] + np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+        J = j[:, np.newaxis] + np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1])
+        inside = (I >= 0) & (I < self.ny) & (J >= 0) & (J < self.nx)
+        cells = (I * self.nx + J).astype(np.int64)
+
+        start = np.searchsorted(self.keys, cells, side = "left").ravel()
+        stop = np.searchsorted(self.keys, cells, side = "right").ravel()
+        counts = np.where(inside.ravel(), stop - start, 0)
+
+        # Gather the points in all the neighbouring cells of each point in
+        # turn, one after the other
+        total = counts.sum()
+        first = np.cumsum(counts) - counts
+        index = np.repeat(start - first, counts) + np.arange(total)
+        owner = np.repeat(np.arange(len(X)),
+                          counts.reshape(-1, 9).sum(axis = 1))
+
+        points = self.points[index]
+        d2 = (points[:, 0] - X[owner])**2 + (points[:, 1] - Y[owner])**2
+
+        distance = np.full(len(X), np.inf)
+        found = np.unique(owner)
+        if len(found) > 0:
+            groups = np.searchsorted(owner, found)
+            distance[found] = np.sqrt(np.minimum.reduceat(d2, groups))
+
+        return distance
+
+
+# -------------------------------------------------------------------------
+def _trace_until_close(interpolator, grid, x0, y0, sign, d_test,
+                       chunk_steps, max_steps, **kwargs):
+    """
+    Trace the streamline from `x0`, `y0` `chunk_steps` steps at a time,
+    stopping it at the last point further than `d_test` from any line in
+    the `OccupancyGrid` `grid`
+
+    Returns:
+    =======
+    X, Y: coordinates of the streamline, not including `x0`, `y0`
+    """
+    Xs = []
+    Ys = []
+    xs, ys = x0, y0
+    steps = 0
+
+    while steps < max_steps:
+        num_steps = min(chunk_steps, max_steps - steps)
+        X, Y = streamlines_batch(None, None, None, None, [xs], [ys], sign,
+                                 max_steps = num_steps,
+                                 interpolator = interpolator, **kwargs)[0]
+        X, Y = X[1:], Y[1:]
+
+        close = np.flatnonzero(grid.distance(X, Y) < d_test)
+        if len(close) > 0:
+            Xs.append(X[:close[0]])
+            Ys.append(Y[:close[0]])
+            break
+
+        Xs.append(X)
+        Ys.append(Y)
+        steps += len(X)
+
+        # The line stopped on its own before using up all its steps
+        if len(X) < num_steps:
+            break
+
+        xs, ys = X[-1], Y[-1]
+
+    return (np.concatenate([np.zeros(0)] + Xs),
+            np.concatenate([np.zeros(0)] + Ys))
+
+
+# -------------------------------------------------------------------------
+def evenly_spaced_streamlines(x, y, vx, vy, d_sep, d_test = None,
+                              X0 = None, Y0 = None, min_length = None,
+                              min_speed = 5.0, max_steps = 10000,
+                              chunk_steps = 64, interpolator = None,
+                              **kwargs):
+    """
+    Cover the velocity field with streamlines that are all about `d_sep`
+    apart, following Jobard and Lefer (1997).
+
+    Each streamline is traced both ways from its seed and stopped as soon
+    as it comes within `d_test` of another one. The points of every
+    streamline kept are added to an `OccupancyGrid` with cells of size
+    `d_sep`, and new seeds are tried `d_sep` to either side of each one in
+    turn, about every `d_sep / 2` along it; a seed is used if it's at
+    least `d_sep` from every streamline so far. When no more seeds can be
+    found along the existing streamlines, the next of the starting points
+    that's still far enough from all of them starts a new one.
+
+    Parameters:
+    ==========
+    x, y, vx, vy: same as for `streamline`
+    d_sep:        distance between neighbouring streamlines
+    d_test:       optional; how close a streamline can get to another one
+                  before it's stopped; by default `d_sep / 2`
+    X0, Y0:       optional; the starting points; by default the points of
+                  a lattice of spacing `d_sep` over the field, fastest first
+    min_length:   optional; streamlines shorter than this are thrown away;
+                  by default `d_test`
+    min_speed, max_steps: optional; see `streamlines_batch`
+    chunk_steps:  optional; number of steps traced between checks of the
+                  distance to the other streamlines
+    interpolator: optional; an `Interpolator` of `vx`, `vy`
+    kwargs:       any other arguments to `streamlines_batch`, e.g. `method`
+                  or `step`
+
+    Returns:
+    =======
+    lines: list of pairs `X, Y` of arrays of the coordinates of each
+           streamline, in the direction of flow
+    """
+    if d_test is None:
+        d_test = 0.5 * d_sep
+    if min_length is None:
+        min_length = d_test
+
+    if interpolator is None:
+        interpolator = Interpolator(x, y, vx, vy)
+    x, y = interpolator.x, interpolator.y
+    kwargs = dict(kwargs, min_speed = min_speed)
+
+    if X0 is None:
+        X0, Y0 = np.meshgrid(np.arange(x[0] + 0.5 * d_sep, x[-1], d_sep),
+                             np.arange(y[0] + 0.5 * d_sep, y[-1], d_sep))
+        X0, Y0 = X0.ravel(), Y0.ravel()
+        u, v, speed, inside = _velocity(interpolator, X0, Y0)
+        order = np.argsort(-speed, kind = "mergesort")
+        X0, Y0 = X0[order], Y0[order]
+
+    grid = OccupancyGrid(x, y, d_sep)
+    lines = []
+    queue = []
+    start = 0
+
+    # Allow for roundoff in the distance from a seed to the line it came from
+    far = (1.0 - 1.0e-6) * d_sep
+
+    # Seeds only ever get closer to the streamlines as more are added, so
+    # any that can't be used now can be thrown out straight away
+    def usable(seeds):
+        instrument.count("streamlines.spaced.seeds_tried", len(seeds))
+        u, v, speed, inside = _velocity(interpolator, seeds[:, 0], seeds[:, 1])
+
+        return (inside & (speed > min_speed) &
+                (grid.distance(seeds[:, 0], seeds[:, 1]) >= far))
+
+    while True:
+        if queue:
+            # Try seeds to either side of the next streamline in the queue
+            X, Y = lines[queue.pop(0)]
+            keep = _decimate_by_distance(X, Y, 0.5 * d_sep)
+            tx = np.gradient(X)[keep]
+            ty = np.gradient(Y)[keep]
+            norm = np.sqrt(tx**2 + ty**2)
+            norm[norm == 0.0] = 1.0
+
+            px, py = -d_sep * ty / norm, d_sep * tx / norm
+            seeds = np.column_stack((X[keep] + px, Y[keep] + py,
+                                     X[keep] - px, Y[keep] - py))
+            seeds = seeds.reshape(-1, 2)
+            seeds = seeds[usable(seeds)]
+        else:
+            # Look for the next starting point far enough from every line
+            seeds = np.zeros((0, 2))
+            while len(seeds) == 0 and start < len(X0):
+                block = np.column_stack((X0[start: start + 1024],
+                                         Y0[start: start + 1024]))
+                found = np.flatnonzero(usable(block))
+                if len(found) > 0:
+                    seeds = block[found[:1]]
+                    start += found[0] + 1
+                else:
+                    start += len(block)
+
+            if len(seeds) == 0:
+                break
+
+        for xs, ys in seeds:
+            if grid.distance(xs, ys)[0] < far:
+                continue
+
+            Xb, Yb = _trace_until_close(interpolator, grid, xs, ys, -1,
+                                        d_test, chunk_steps, max_steps,
+                                        **kwargs)
+            Xf, Yf = _trace_until_close(interpolator, grid, xs, ys, 1,
+                                        d_test, chunk_steps, max_steps,
+                                        **kwargs)
+
+            X = np.concatenate((Xb[::-1], [xs], Xf))
+            Y = np.concatenate((Yb[::-1], [ys], Yf))
+
+            length = np.sum(np.sqrt(np.diff(X)**2 + np.diff(Y)**2))
+            if length < min_length:
+                continue
+
+            grid.add(X, Y)
+            lines.append((X, Y))
+            queue.append(len(lines) - 1)
+            instrument.count("streamlines.spaced.lines")
+
+    return lines
 
 
 # ---------------------------------------------------------------
-def streamlines_from_shapefile(x, y, vx, vy, filename, sign = 1):
+def streamlines_from_shapefile(x, y, vx, vy, filename, sign = 1,
+                               method = "euler", tol = 1.0, workers = 1,
+                               interpolator = None):
     """
     Given an ESRI shapefile, read in all the points it contains and
     generate streamlines from them.
@@ -118,46 +926,53 @@ def streamlines_from_shapefile(x, y, vx, vy, filename, sign = 1):
     ==========
     x, y, vx, vy: same as in last function
     filename: name of .shp file from which we get start points
+    method, tol: optional; integration method, see `streamline`
+    workers: optional; number of processes to trace the streamlines on
+    interpolator: optional; an `Interpolator` of `vx`, `vy`, used to trace
+                  the streamlines, whether in this process or shared with
+                  the workers
 
     Returns:
     =======
     lines: array of streamlines
     """
 
-    sf = Reader(filename)
-    shape = sf.shapes()[0]
-    num_pts = len(shape.points)
-
-    X0 = np.zeros(num_pts, dtype = np.float64)
-    Y0 = np.zeros(num_pts, dtype = np.float64)
-
-    for i in range(num_pts):
-        X0[i] = shape.points[i][0]
-        Y0[i] = shape.points[i][1]
+    seeds = Polylines.read(filename)[0]
+    X0 = seeds[:, 0]
+    Y0 = seeds[:, 1]
 
     lines = []
 
-    for i in range(num_pts):
-        X, Y = streamline(x, y, vx, vy, X0[i], Y0[i], sign)
+    if workers > 1:
+        results = streamlines_parallel(x, y, vx, vy, X0, Y0, sign,
+                                       workers = workers,
+                                       interpolator = interpolator,
+                                       method = method, tol = tol)
+    else:
+        results = streamlines_batch(x, y, vx, vy, X0, Y0, sign,
+                                    method = method, tol = tol,
+                                    interpolator = interpolator)
 
-        line = []
-        for k in range(len(X)):
-            line.append([X[k], Y[k]])
-        lines.append(line)
+    for X, Y in results:
+        lines.append(np.column_stack((X, Y)).tolist())
 
     return lines
 
 
 # -------------------------------------
+@instrument.timed("streamlines.write")
 def write_streamlines(lines, filename):
     """
     Given an array of streamlines, write them out to a shapefile.
 
     Parameters:
     ==========
-    lines: array of arrays of tuples, coordinates along each streamline
+    lines: array of arrays of tuples, coordinates along each streamline,
+           or a `Polylines`
     filename: name for output file
     """
+    if isinstance(lines, Polylines):
+        lines = lines.to_parts()
 
     strm = Writer()
     strm.autoBalance = 1
@@ -166,38 +981,61 @@ def write_streamlines(lines, filename):
     for line in lines:
         strm.line(parts = [line])
         strm.record('')
+    instrument.count("streamlines.lines_written", len(lines))
 
     strm.save(filename)
 
 
 # -------------------------------------
+@instrument.timed("streamlines.make_streamlines")
 def make_streamlines(velocity_filename,
                      initial_shapefile,
                      streamlines_shapefile,
-                     inflow = 1):
+                     inflow = 1,
+                     method = "euler",
+                     tol = 1.0,
+                     workers = 1,
+                     cache_dir = None,
+                     d_sep = 1000.0):
     """
     Parameters:
     ==========
     velocity_filename:     stem of the geodat filenames for the ice
                            velocities
     initial_shapefile:     shapefile containing the points from which
-                           to create the streamlines
+                           to create the streamlines, or None to cover the
+                           whole field with evenly spaced streamlines; see
+                           `evenly_spaced_streamlines`
     streamlines_shapefile: shapefile to write streamlines to
     inflow:                optional argument; specify whether the start
                            points are at the glacier inflow or outflow
+    method:                optional; "euler", "rk4" or "rk45", the method
+                           used to integrate the streamlines
+    tol:                   optional; error tolerance, in meters, for "rk45"
+    workers:               optional; number of processes to trace the
+                           streamlines on
+    cache_dir:             optional; directory in which to cache the
+                           gap-filled velocities, see
+                           `velocity.read_velocities`
+    d_sep:                 optional; distance between the evenly spaced
+                           streamlines, if there's no `initial_shapefile`
     """
 
-    x, y, vx = read_geodat(velocity_filename + ".vx")
-    x, y, vy = read_geodat(velocity_filename + ".vy")
-
-    ny, nx = np.shape(vx)
-    for i in range(ny):
-        for j in range(nx):
-            if vx[i, j] == -2.0e+9:
-                vx[i, j] = 0.0
-                vy[i, j] = 0.0
+    field = VelocityField.read(velocity_filename, cache_dir = cache_dir)
+    interpolator = field.interpolator()
+    vx = interpolator.q[:, :, 0]
+    vy = interpolator.q[:, :, 1]
 
-    lines = streamlines_from_shapefile(x, y, vx, vy,
-                                       initial_shapefile, inflow)
+    if initial_shapefile is None:
+        lines = evenly_spaced_streamlines(field.x, field.y, vx, vy, d_sep,
+                                          method = method, tol = tol,
+                                          interpolator = interpolator)
+        lines = [np.column_stack((X, Y)).tolist() for X, Y in lines]
+    else:
+        lines = streamlines_from_shapefile(field.x, field.y, vx, vy,
+                                           initial_shapefile, inflow,
+                                           method = method, tol = tol,
+                                           workers = workers,
+                                           interpolator = interpolator)
 
     write_streamlines(lines, streamlines_shapefile)
@@ -0,0 +1,234 @@
+import numpy as np
+import shutil
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from geodat import open_geodat, geodat_tiles, missing_value
+from idw import fill_points
+import instrument
+
+
+# -----------------------------------------------------
+def _is_geotiff(filename):
+    return filename.lower().endswith((".tif", ".tiff"))
+
+
+# ------------------------
+def open_blocks(filename):
+    """
+    Open a geodat or GeoTIFF file for reading in blocks.
+
+    Returns:
+    =======
+    ny, nx: the size of the grid
+    read:   read(rows, cols) returns the block of data in the slices
+            `rows, cols` as a float64 array
+    close:  function to call when done reading
+    """
+    if _is_geotiff(filename):
+        import rasterio
+        from rasterio.windows import Window
+
+        src = rasterio.open(filename)
+
+        def read(rows, cols):
+            window = Window(cols.start, rows.start,
+                            cols.stop - cols.start, rows.stop - rows.start)
+            return src.read(1, window = window).astype(np.float64)
+
+        return src.height, src.width, read, src.close
+
+    x, y, data = open_geodat(filename)
+    ny, nx = data.shape
+
+    def read(rows, cols):
+        block = data[rows, cols].astype(np.float64)
+        instrument.count("geodat.bytes_read", 4 * block.size)
+        return block
+
+    return ny, nx, read, lambda: None
+
+
+# -----------------------------------------------
+def create_blocks(filename, template):
+    """
+    Create a file of the same kind and size as the geodat or GeoTIFF file
+    `template` for writing in blocks; geodat output is big-endian float32,
+    GeoTIFF output is tiled, compressed float32
+
+    Returns:
+    =======
+    write: write(rows, cols, block) writes the block of data to the slices
+           `rows, cols` of the file
+    close: function to call when done writing
+    """
+    if _is_geotiff(template):
+        import rasterio
+        from rasterio.windows import Window
+
+        with rasterio.open(template) as src:
+            profile = src.profile
+        profile.update(dtype = rasterio.float32, count = 1, tiled = True,
+                       blockxsize = 512, blockysize = 512,
+                       compress = "deflate")
+        dst = rasterio.open(filename, "w", **profile)
+
+        def write(rows, cols, block):
+            window = Window(cols.start, rows.start,
+                            cols.stop - cols.start, rows.stop - rows.start)
+            dst.write(block.astype(np.float32), 1, window = window)
+
+        return write, dst.close
+
+    x, y, data = open_geodat(template)
+    shutil.copyfile(template + ".geodat", filename + ".geodat")
+    out = np.memmap(filename, dtype = '>f4', mode = 'w+', shape = data.shape)
+
+    def write(rows, cols, block):
+        out[rows, cols] = block
+        out.flush()
+
+    return write, out.flush
+
+
+# ------------------------------------------------------
+def label_holes_tiled(ny, nx, read, missing, tile = 2048):
+    """
+    Label the regions of a grid that are missing data, one tile at a time,
+    without holding the whole grid in memory.
+
+    Each tile is labelled on its own; regions that cross tile boundaries
+    are then joined up by matching the labels along the edges of
+    neighbouring tiles.
+
+    Parameters:
+    ==========
+    ny, nx, read: the grid, as returned by `open_blocks`
+    missing:      the value used to flag missing data
+    tile:         optional; size of the tiles
+
+    Returns:
+    =======
+    offsets:  offsets[rows, cols] = the number added to the labels of the
+              tile `rows, cols` computed by `ndimage.label` to get global
+              labels
+    regions:  regions[l] = the region that global label `l` belongs to
+    sizes:    sizes[k] = the number of points in region `k`
+    exterior: exterior[k] = True if region `k` touches the edge of the grid
+    """
+    offsets = {}
+    label_sizes = [np.zeros(1)]
+    label_exterior = [np.zeros(1, dtype = bool)]
+    edges = {}
+    total = 0
+
+    for rows, cols in geodat_tiles(nx, ny, tile):
+        labels, num_labels = ndimage.label(read(rows, cols) == missing)
+        labels[labels > 0] += total
+        offsets[rows.start, cols.start] = total
+
+        sizes = np.bincount(labels.ravel(), minlength = total + num_labels + 1)
+        label_sizes.append(sizes[total + 1:])
+
+        touches = np.zeros(total + num_labels + 1, dtype = bool)
+        if rows.start == 0:
+            touches[labels[0, :]] = True
+        if rows.stop == ny:
+            touches[labels[-1, :]] = True
+        if cols.start == 0:
+            touches[labels[:, 0]] = True
+        if cols.stop == nx:
+            touches[labels[:, -1]] = True
+        label_exterior.append(touches[total + 1:])
+
+        edges[rows.start, cols.start] = (labels[0, :], labels[-1, :],
+                                         labels[:, 0], labels[:, -1])
+        total += num_labels
+
+    # Join up the labels on either side of every tile boundary
+    pairs = [np.zeros((2, 0), dtype = int)]
+    for (i, j), (top, bottom, left, right) in edges.items():
+        for neighbour, a, side in [((i + tile, j), bottom, 0),
+                                   ((i, j + tile), right, 2)]:
+            if neighbour in edges:
+                b = edges[neighbour][side]
+                both = (a > 0) & (b > 0)
+                pairs.append(np.array([a[both], b[both]]))
+
+    pairs = np.concatenate(pairs, axis = 1)
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])),
+                       shape = (total + 1, total + 1))
+    num_regions, regions = connected_components(graph, directed = False)
+
+    label_sizes = np.concatenate(label_sizes)
+    label_exterior = np.concatenate(label_exterior)
+
+    sizes = np.bincount(regions, weights = label_sizes,
+                        minlength = num_regions)
+    exterior = np.bincount(regions, weights = label_exterior,
+                           minlength = num_regions) > 0
+
+    # Label 0 is the region of points with data
+    instrument.count("idw.holes_found", num_regions - 1)
+
+    return offsets, regions, sizes, exterior
+
+
+# -------------------------------------------------------------------
+def fill_missing_tiled(filename, output_filename, missing = missing_value,
+                       d = 12, tile = 2048, max_hole_size = None,
+                       method = "window", workers = 1):
+    """
+    Fill in the interior missing points of a geodat or GeoTIFF file, like
+    `idw.fill_missing_data`, but one tile at a time, writing the result
+    out to a new file of the same kind as it goes. Peak memory depends on
+    the tile size, not the size of the grid.
+
+    Each tile is read along with a halo of `d` points on each side, so the
+    results are the same as filling the whole grid at once.
+
+    Parameters:
+    ==========
+    filename:        the geodat or GeoTIFF file to fill in
+    output_filename: the file to write the result to
+    missing:         optional; the value used to flag missing data
+    d:               optional; half-width of the window used to fill each
+                     missing point
+    tile:            optional; size of the tiles
+    max_hole_size, method, workers: same as for `idw.fill_missing_data`
+    """
+    ny, nx, read, close_input = open_blocks(filename)
+    offsets, regions, sizes, exterior = \
+        label_holes_tiled(ny, nx, read, missing, tile)
+
+    fillable = ~exterior
+    fillable[regions[0]] = False
+    if max_hole_size is not None:
+        fillable &= sizes <= max_hole_size
+
+    write, close_output = create_blocks(output_filename, filename)
+
+    for rows, cols in geodat_tiles(nx, ny, tile):
+        halo_rows = slice(max(rows.start - d, 0), min(rows.stop + d, ny))
+        halo_cols = slice(max(cols.start - d, 0), min(cols.stop + d, nx))
+        i0 = rows.start - halo_rows.start
+        j0 = cols.start - halo_cols.start
+
+        q = read(halo_rows, halo_cols)
+        core = q[i0: i0 + rows.stop - rows.start,
+                 j0: j0 + cols.stop - cols.start]
+
+        # Labelling the tile again gives the same labels as the first pass
+        labels, num_labels = ndimage.label(core == missing)
+        labels[labels > 0] += offsets[rows.start, cols.start]
+        I, J = np.where((labels > 0) & fillable[regions[labels]])
+
+        p = np.copy(q)
+        fill_points(p, q, missing, I + i0, J + j0, d, method, workers)
+
+        write(rows, cols, p[i0: i0 + rows.stop - rows.start,
+                            j0: j0 + cols.stop - cols.start])
+
+    close_input()
+    close_output()
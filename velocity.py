@@ -0,0 +1,266 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from geodat import read_geodat_header, open_geodat, no_data_mask, \
+    missing_value
+from idw import fill_missing_data
+from interpolator import Interpolator
+import instrument
+
+
+# Bump this whenever the preprocessing changes, so that stale cache entries
+# are never used
+_cache_version = 3
+
+
+# ------------------------------------------------
+def _fingerprint(filenames, **params):
+    """
+    Make a key identifying the files `filenames`, as they are now on disk,
+    and the parameters they're processed with
+    """
+    info = {"version": _cache_version, "params": params, "files": []}
+    for filename in filenames:
+        stat = os.stat(filename)
+        info["files"].append([os.path.abspath(filename),
+                              stat.st_size, stat.st_mtime_ns])
+
+    text = json.dumps(info, sort_keys = True)
+
+    return hashlib.sha1(text.encode("utf-8")).hexdigest(), info
+
+
+# --------------------------
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+# ----------------------------------------
+def evict(cache_dir, max_bytes):
+    """
+    Remove the least recently used entries from the cache in `cache_dir`
+    until it takes up no more than `max_bytes`
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith("."):
+            entries.append((os.path.getmtime(path), _entry_size(path), path))
+
+    entries.sort()
+    total = sum(size for used, size, path in entries)
+
+    while entries and total > max_bytes:
+        used, size, path = entries.pop(0)
+        shutil.rmtree(path, ignore_errors = True)
+        total -= size
+
+
+class VelocityField(object):
+    """
+    The x- and y-velocities of a mosaic, stored together as one float32
+    array of shape `(ny, nx, 2)`, so that sampling both components at a
+    point reads adjacent memory.
+
+    Where there are no data is worked out once, when the field is made, and
+    kept as a boolean mask; the missing-data flags in the velocities are
+    replaced by `fill_value` in place, so the velocities can be used as is.
+    The magnitude and direction are only computed when first asked for.
+
+    Parameters:
+    ==========
+    x, y:       the grid coordinates
+    v:          array of shape `(len(y), len(x), 2)` of the velocities
+    valid:      optional; boolean array, True where there are data; if not
+                given, it's found from the missing-data flags in `v`
+    missing:    optional; the value used to flag missing data
+    fill_value: optional; the value the velocity is set to where there are
+                no data, e.g. 0 or NaN
+    """
+
+    def __init__(self, x, y, v, valid = None, missing = missing_value,
+                 fill_value = 0.0):
+        self.x = x
+        self.y = y
+        self.v = v
+        self.missing = missing
+
+        if valid is None:
+            valid = ~(no_data_mask(v[:, :, 0], missing) |
+                      no_data_mask(v[:, :, 1], missing))
+            v[~valid] = fill_value
+        self.valid = valid
+
+        self._magnitude = None
+        self._direction = None
+
+    @classmethod
+    def read(cls, velocity_filename, missing = missing_value, fill = True,
+             d = 12, fill_value = 0.0,
+             cache_dir = None, max_cache_bytes = 16 * 2**30):
+        """
+        Read the x- and y-velocities of a geodat mosaic from the files
+        "velocity_filename.vx" and "velocity_filename.vy", checking that
+        they're on the same grid, and optionally fill in small patches of
+        missing data.
+
+        If `cache_dir` is given, the results are stored there as .npy
+        files, so that the next call with the same, unmodified files and
+        the same parameters memory-maps them instead of doing all the work
+        again. The cache is kept under `max_cache_bytes` by removing the
+        entries used least recently.
+
+        Parameters:
+        ==========
+        velocity_filename: stem of the geodat filenames for the ice
+                           velocities
+        missing:           optional; the value used to flag missing data
+        fill:              optional; whether to fill in missing data
+        d:                 optional; half-width of the window used to fill
+                           missing data
+        fill_value:        optional; see `VelocityField`
+        cache_dir:         optional; directory to cache the results in
+        max_cache_bytes:   optional; size limit of the cache
+        """
+        filenames = [velocity_filename + ext
+                     for ext in (".vx", ".vx.geodat", ".vy", ".vy.geodat")]
+
+        if cache_dir is not None:
+            key, info = _fingerprint(filenames, missing = missing,
+                                     fill = fill, d = d,
+                                     fill_value = repr(fill_value))
+            path = os.path.join(cache_dir, key)
+
+            if os.path.isdir(path):
+                os.utime(path, None)
+                x, y, v, valid = (np.load(os.path.join(path, name + ".npy"),
+                                          mmap_mode = "r")
+                                  for name in ("x", "y", "v", "valid"))
+                return cls(x, y, v, valid, missing, fill_value)
+
+        if (read_geodat_header(velocity_filename + ".vx") !=
+            read_geodat_header(velocity_filename + ".vy")):
+            raise ValueError("The x- and y-velocities of {0} are on "
+                             "different grids".format(velocity_filename))
+
+        x, y, vx = open_geodat(velocity_filename + ".vx")
+        x, y, vy = open_geodat(velocity_filename + ".vy")
+
+        with instrument.timer("geodat.read"):
+            v = np.empty(vx.shape + (2,), dtype = np.float32)
+            v[:, :, 0] = vx
+            v[:, :, 1] = vy
+        instrument.count("geodat.bytes_read", v.nbytes)
+
+        if fill:
+            v[:, :, 0] = fill_missing_data(v[:, :, 0], missing, d)
+            v[:, :, 1] = fill_missing_data(v[:, :, 1], missing, d)
+
+        field = cls(x, y, v, None, missing, fill_value)
+
+        if cache_dir is not None:
+            _store(cache_dir, path, info, max_cache_bytes,
+                   x = x, y = y, v = v, valid = field.valid)
+
+        return field
+
+    @property
+    def vx(self):
+        return self.v[:, :, 0]
+
+    @property
+    def vy(self):
+        return self.v[:, :, 1]
+
+    @property
+    def magnitude(self):
+        """
+        The speed, set to `fill_value` where there are no data
+        """
+        if self._magnitude is None:
+            self._magnitude = np.hypot(self.vx, self.vy)
+
+        return self._magnitude
+
+    @property
+    def direction(self):
+        """
+        The direction of flow, in radians counterclockwise from the x-axis
+        """
+        if self._direction is None:
+            self._direction = np.arctan2(self.vy, self.vx)
+
+        return self._direction
+
+    def with_no_data(self, q, value = None):
+        """
+        Return a copy of the field `q`, e.g. `vx` or `magnitude`, with
+        `value`, by default the missing-data flag, wherever there are no
+        data, for writing out to other formats
+        """
+        if value is None:
+            value = self.missing
+
+        return np.where(self.valid, q, np.array(value, dtype = q.dtype))
+
+    def interpolator(self, stop_at_no_data = False):
+        """
+        Make an `Interpolator` of the velocities, which shares their memory.
+
+        By default the velocities are interpolated through places with no
+        data as if the velocity were `fill_value` there; if
+        `stop_at_no_data` is True, points in any cell touching a place with
+        no data count as outside the grid instead.
+        """
+        valid = self.valid if stop_at_no_data else None
+
+        return Interpolator.from_stacked(self.x, self.y, self.v, valid)
+
+
+# ----------------------------------------------------------
+def _store(cache_dir, path, info, max_cache_bytes, **arrays):
+    """
+    Store the `arrays` in the cache entry at `path`
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Write the entry to a temporary directory and move it into place
+    # once it's complete, so no one ever reads a partial entry
+    tmp = tempfile.mkdtemp(prefix = ".", dir = cache_dir)
+    for name, q in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), q)
+    with open(os.path.join(tmp, "meta.json"), "w") as meta_file:
+        json.dump(info, meta_file, indent = 2)
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Someone else cached the same thing in the meantime
+        shutil.rmtree(tmp, ignore_errors = True)
+
+    evict(cache_dir, max_cache_bytes)
+
+
+# ---------------------------------------------------------------------
+def read_velocities(velocity_filename, missing = missing_value, d = 12,
+                    cache_dir = None, max_cache_bytes = 16 * 2**30):
+    """
+    Read the x- and y-velocities of a geodat mosaic, fill in any small
+    patches of missing data, and set the velocity to zero wherever data are
+    still missing; see `VelocityField.read` for the arguments
+
+    Returns:
+    =======
+    x, y:   the grid coordinates
+    vx, vy: the velocities
+    """
+    field = VelocityField.read(velocity_filename, missing, d = d,
+                               cache_dir = cache_dir,
+                               max_cache_bytes = max_cache_bytes)
+
+    return field.x, field.y, field.vx, field.vy